@@ -20,6 +20,12 @@ class MotionModuleType(Enum):
     HotShotXL = "HotShot-XL, John Mullan, Natural Synthetics Inc"
 
 
+    @staticmethod
+    def from_metadata(metadata: dict[str, str]):
+        mm_type = metadata.get("mm_type", None)
+        return MotionModuleType[mm_type] if mm_type in MotionModuleType.__members__ else None
+
+
     @staticmethod
     def get_mm_type(state_dict: dict[str, torch.Tensor]):
         keys = list(state_dict.keys())
@@ -52,6 +58,7 @@ class MotionWrapper(nn.Module):
         self.is_adxl = mm_type == MotionModuleType.AnimateDiffXL
         self.is_xl = self.is_hotshot or self.is_adxl
         max_len = 32 if (self.is_v2 or self.is_adxl or self.is_v3) else 24
+        self.max_len = max_len
         in_channels = (320, 640, 1280) if (self.is_xl) else (320, 640, 1280, 1280)
         self.down_blocks = nn.ModuleList([])
         self.up_blocks = nn.ModuleList([])
@@ -63,12 +70,38 @@ class MotionWrapper(nn.Module):
         self.mm_name = mm_name
         self.mm_type = mm_type
         self.mm_hash = mm_hash
+        self.source_hash = None
+        self.video_length = None
+        self.video_count = 1
 
 
     def enable_gn_hack(self):
         return not (self.is_adxl or self.is_v3)
 
 
+    def set_video_length(self, video_length: Optional[int]):
+        # Number of frames per video in the UNet batch. None means the batch is one video for cond and one for uncond.
+        self.video_length = video_length
+        for module in self.modules():
+            if isinstance(module, TemporalTransformer3DModel):
+                module.video_length = video_length
+
+
+    def set_video_count(self, video_count: int):
+        # Number of videos per cond / uncond half when the video length is not set.
+        self.video_count = video_count
+        for module in self.modules():
+            if isinstance(module, TemporalTransformer3DModel):
+                module.video_count = video_count
+
+
+    def set_attention_slice(self, slice_size: Optional[int]):
+        # Split attention over the batch axis in slices of slice_size rows, also when an attention optimizer is active. None disables slicing.
+        for module in self.modules():
+            if isinstance(module, CrossAttention):
+                module._slice_size = slice_size
+
+
 class MotionModule(nn.Module):
     def __init__(self, in_channels, num_mm, max_len, is_hotshot=False):
         super().__init__()
@@ -171,9 +204,11 @@ class TemporalTransformer3DModel(nn.Module):
             ]
         )
         self.proj_out = nn.Linear(inner_dim, in_channels)    
+        self.video_length = None
+        self.video_count = 1
     
     def forward(self, hidden_states, encoder_hidden_states=None, attention_mask=None):
-        video_length = hidden_states.shape[0] // (2 if shared.opts.batch_cond_uncond else 1)
+        video_length = self.video_length or hidden_states.shape[0] // ((2 if shared.opts.batch_cond_uncond else 1) * self.video_count)
         batch, channel, height, weight = hidden_states.shape
         residual = hidden_states
 
@@ -405,7 +440,7 @@ class CrossAttention(nn.Module):
                 attention_mask = attention_mask.repeat_interleave(self.heads, dim=0)
 
         # attention, what we cannot get enough of
-        if sd_hijack.current_optimizer is not None and sd_hijack.current_optimizer.name in ["xformers", "sdp", "sdp-no-mem", "sub-quadratic"]:
+        if self._slice_size is None and sd_hijack.current_optimizer is not None and sd_hijack.current_optimizer.name in ["xformers", "sdp", "sdp-no-mem", "sub-quadratic"]:
             hidden_states = self._memory_efficient_attention(query, key, value, attention_mask, sd_hijack.current_optimizer.name)
             # Some versions of xformers return output in fp32, cast it back to the dtype of the input
             hidden_states = hidden_states.to(query.dtype)
@@ -454,14 +489,14 @@ class CrossAttention(nn.Module):
         return hidden_states
 
     def _sliced_attention(self, query, key, value, sequence_length, dim, attention_mask):
+        # temporal attention runs over frames, so take the sequence length from query instead of the input of forward
         batch_size_attention = query.shape[0]
         hidden_states = torch.zeros(
-            (batch_size_attention, sequence_length, dim // self.heads), device=query.device, dtype=query.dtype
+            (batch_size_attention, query.shape[1], dim // self.heads), device=query.device, dtype=query.dtype
         )
         slice_size = self._slice_size if self._slice_size is not None else hidden_states.shape[0]
-        for i in range(hidden_states.shape[0] // slice_size):
-            start_idx = i * slice_size
-            end_idx = (i + 1) * slice_size
+        for start_idx in range(0, hidden_states.shape[0], slice_size):
+            end_idx = min(start_idx + slice_size, hidden_states.shape[0])
 
             query_slice = query[start_idx:end_idx]
             key_slice = key[start_idx:end_idx]
@@ -471,7 +506,7 @@ class CrossAttention(nn.Module):
                 key_slice = key_slice.float()
 
             attn_slice = torch.baddbmm(
-                torch.empty(slice_size, query.shape[1], key.shape[1], dtype=query_slice.dtype, device=query.device),
+                torch.empty(end_idx - start_idx, query.shape[1], key.shape[1], dtype=query_slice.dtype, device=query.device),
                 query_slice,
                 key_slice.transpose(-1, -2),
                 beta=0,
@@ -551,11 +586,7 @@ class CrossAttention(nn.Module):
 
         if fallthrough:
             fallthrough = False
-            if self._slice_size is None or query.shape[0] // self._slice_size == 1:
-                hidden_states = self._attention(query, key, value, attention_mask)
-            else:
-                hidden_states = self._sliced_attention(query, key, value, sequence_length, dim, attention_mask)
-            return hidden_states
+            return self._attention(q, k, v, mask)
 
         hidden_states = self.reshape_batch_dim_to_heads(hidden_states)        
         return hidden_states
@@ -632,7 +663,7 @@ class VersatileAttention(CrossAttention):
             optimizer_collections = optimizer_collections[1:]
 
         # attention, what we cannot get enough of
-        if sd_hijack.current_optimizer is not None and sd_hijack.current_optimizer.name in optimizer_collections:
+        if self._slice_size is None and sd_hijack.current_optimizer is not None and sd_hijack.current_optimizer.name in optimizer_collections:
             optimizer_name = sd_hijack.current_optimizer.name
             if xformers_option == "Optimize attention layers with sdp (torch >= 2.0.0 required)" and optimizer_name == "xformers":
                 optimizer_name = "sdp" # "Optimize attention layers with sdp (torch >= 2.0.0 required)"
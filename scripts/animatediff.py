@@ -6,6 +6,7 @@ from modules.processing import (Processed, StableDiffusionProcessing,
 from modules.scripts import PostprocessBatchListArgs, PostprocessImageArgs
 
 from scripts.animatediff_cn import AnimateDiffControl
+from scripts.animatediff_estimate import AnimateDiffEstimate
 from scripts.animatediff_infv2v import AnimateDiffInfV2V
 from scripts.animatediff_latent import AnimateDiffI2VLatent
 from scripts.animatediff_logger import logger_animatediff as logger
@@ -57,10 +58,19 @@ class AnimateDiffScript(scripts.Script):
             params = self.ad_params
         if params.enable:
             logger.info("AnimateDiff process start.")
-            params.set_p(p)
+            # WebUI only logs errors of before_process and samples anyway, so fail before anything is injected
+            params._check()
             motion_module.inject(p.sd_model, params.model)
+            try:
+                # auto context batch size needs max_len of the injected motion module
+                params.set_p(p)
+            except Exception:
+                motion_module.restore(p.sd_model)
+                raise
             self.prompt_scheduler = AnimateDiffPromptSchedule()
             self.lora_hacker = AnimateDiffLora(motion_module.mm.is_v2)
+            # a batch that raised never reached postprocess_batch, undo its motion LoRA merge
+            self.lora_hacker.unmerge()
             self.lora_hacker.hack()
             self.cfg_hacker = AnimateDiffInfV2V(p, self.prompt_scheduler)
             self.cfg_hacker.hack(params)
@@ -82,6 +92,18 @@ class AnimateDiffScript(scripts.Script):
             AnimateDiffI2VLatent().randomize(p, params)
 
 
+    def process_batch(self, p: StableDiffusionProcessing, params: AnimateDiffProcess, **kwargs):
+        if p.is_api and isinstance(params, dict): params = self.ad_params
+        if params.enable:
+            self.lora_hacker.merge()
+
+
+    def postprocess_batch(self, p: StableDiffusionProcessing, params: AnimateDiffProcess, **kwargs):
+        if p.is_api and isinstance(params, dict): params = self.ad_params
+        if params.enable:
+            self.lora_hacker.unmerge()
+
+
     def postprocess_batch_list(self, p: StableDiffusionProcessing, pp: PostprocessBatchListArgs, params: AnimateDiffProcess, **kwargs):
         if p.is_api and isinstance(params, dict): params = self.ad_params
         if params.enable:
@@ -229,6 +251,135 @@ def on_ui_settings():
             section=section
         )
     )
+    shared.opts.add_option(
+        "animatediff_enable_picard",
+        shared.OptionInfo(
+            False,
+            "Enable experimental Picard (parallel-in-time) sampler, requires restart",
+            gr.Checkbox,
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_picard_window",
+        shared.OptionInfo(
+            4,
+            "Picard sampler: number of sampling steps evaluated in one call",
+            gr.Slider,
+            {
+                "minimum": 1,
+                "maximum": 16,
+                "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_picard_tolerance",
+        shared.OptionInfo(
+            0.1,
+            "Picard sampler: tolerance for accepting a step, relative to the noise it removes (lower is closer to Euler but slower)",
+            gr.Slider,
+            {
+                "minimum": 0.01,
+                "maximum": 1,
+                "step": 0.01},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_pin_memory",
+        shared.OptionInfo(
+            True,
+            "Keep motion module weights in pinned CPU memory when moved to CPU, speeds up moving them back to GPU",
+            gr.Checkbox,
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_windows_per_call",
+        shared.OptionInfo(
+            1,
+            "Number of context windows to batch into one UNet call (higher is faster on large GPUs but uses more VRAM)",
+            gr.Slider,
+            {
+                "minimum": 1,
+                "maximum": 16,
+                "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_context_fuse",
+        shared.OptionInfo(
+            "Last window",
+            "How to combine predictions of overlapping context windows",
+            gr.Radio,
+            {"choices": ["Last window", "Flat", "Pyramid", "Gaussian"]},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_prune_windows",
+        shared.OptionInfo(
+            False,
+            "Skip context windows that only repeat frames already covered by other windows of the same step (faster, but results differ from unpruned windows)",
+            gr.Checkbox,
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_prune_threshold",
+        shared.OptionInfo(
+            0,
+            "Also skip covered context windows when at most this fraction of their frames are not covered by earlier windows",
+            gr.Slider,
+            {
+                "minimum": 0,
+                "maximum": 1,
+                "step": 0.05},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_converge_freeze",
+        shared.OptionInfo(
+            False,
+            "With a convergence threshold, stop denoising context windows whose frames have converged while other windows keep refining",
+            gr.Checkbox,
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_latent_offload",
+        shared.OptionInfo(
+            False,
+            "Keep latents of all frames in CPU memory during sampling, only move context windows to GPU (for very long videos, slower)",
+            gr.Checkbox,
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_checkpoint_interval",
+        shared.OptionInfo(
+            0,
+            "Save a checkpoint of API jobs with request_id every N sampling steps, resume with \"resume\": true (0 to disable)",
+            gr.Slider,
+            {
+                "minimum": 0,
+                "maximum": 50,
+                "step": 1},
+            section=section
+        )
+    )
+    shared.opts.add_option(
+        "animatediff_lora_premerge",
+        shared.OptionInfo(
+            False,
+            "Merge motion LoRA into motion module weights before sampling instead of applying it on every forward pass",
+            gr.Checkbox,
+            section=section
+        )
+    )
     shared.opts.add_option(
         "animatediff_s3_enable",
         shared.OptionInfo(
@@ -284,7 +435,37 @@ def on_ui_settings():
         ),
     )    
     
+def on_app_started(_, app):
+    """
+    Refuse API jobs with invalid AnimateDiff parameters with HTTP 422 while the request is parsed, before it is queued.
+    Errors raised from before_process would only be logged, and WebUI would sample the job without AnimateDiff.
+    """
+    from fastapi import HTTPException
+    from modules.api.api import Api
+
+    if getattr(Api.init_script_args, "animatediff_checked", False):
+        return
+    original_init_script_args = Api.init_script_args
+
+    def init_script_args(self, request, *args, **kwargs):
+        for name, script in (request.alwayson_scripts or {}).items():
+            script_args = script.get("args", None) if name.lower() == "animatediff" and isinstance(script, dict) else None
+            if script_args and isinstance(script_args[0], dict):
+                try:
+                    params = AnimateDiffProcess(**script_args[0])
+                    if params.enable:
+                        params._check()
+                except (AssertionError, TypeError) as e:
+                    raise HTTPException(status_code=422, detail=f"AnimateDiff: {e}")
+        return original_init_script_args(self, request, *args, **kwargs)
+
+    init_script_args.animatediff_checked = True
+    Api.init_script_args = init_script_args
+
+
 script_callbacks.on_ui_settings(on_ui_settings)
 script_callbacks.on_after_component(AnimateDiffUiGroup.on_after_component)
 script_callbacks.on_before_ui(AnimateDiffUiGroup.on_before_ui)
 script_callbacks.on_infotext_pasted(infotext_pasted)
+script_callbacks.on_app_started(AnimateDiffEstimate.on_app_started)
+script_callbacks.on_app_started(on_app_started)
@@ -0,0 +1,222 @@
+import functools
+import hashlib
+import inspect
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import torch
+
+from modules import shared
+from modules.processing import StableDiffusionProcessing, StableDiffusionProcessingImg2Img
+
+from scripts.animatediff_logger import logger_animatediff as logger
+from scripts.animatediff_ui import AnimateDiffProcess
+
+
+class AnimateDiffCheckpoint:
+    """
+    Saves the sampler latent of API jobs with a request_id every few sampling steps, so that a job interrupted by
+    a crash or restart can resume from its last checkpoint instead of starting over.
+    A checkpoint belongs to one sampling pass (batch count iteration, streaming chunk or hires fix pass), has its own file
+    and is deleted when that pass finishes, so passes sampled again on resume do not touch the checkpoint of a later pass. Files are written by a background thread, so sampling does not wait for the disk.
+    """
+
+    original_sample = None
+    original_sample_img2img = None
+    original_callback_state = None
+    writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="animatediff_checkpoint")
+
+    def __init__(self):
+        self.p = None
+        self.params = None
+        self.path = None
+        self.job_key = None
+        self.pass_key = None
+        self.step_offset = 0
+        self.pending = None
+        self.owned = False
+
+
+    @staticmethod
+    def get_interval():
+        return int(shared.opts.data.get("animatediff_checkpoint_interval", 0))
+
+
+    def _pass_key(self, p: StableDiffusionProcessing, x: torch.Tensor, sampler) -> dict:
+        # everything that has to match for a checkpoint to continue this sampling pass
+        return {
+            "iteration": str(p.iteration),
+            "seed": str(p.seeds[0] if getattr(p, "seeds", None) else p.seed),
+            "shape": json.dumps(list(x.shape)),
+            "steps": str(p.steps),
+            "sampler": str(sampler.funcname),
+        }
+
+
+    @staticmethod
+    def _job_key(p: StableDiffusionProcessing, params: AnimateDiffProcess) -> dict:
+        # the job a checkpoint belongs to, taken before sampling changes any parameter: AnimateDiff parameters and prompts
+        prompts = json.dumps([p.prompt, p.negative_prompt, getattr(p, "styles", None)], default=str)
+        return {
+            "params": params.get_dict(isinstance(p, StableDiffusionProcessingImg2Img)),
+            "prompt_sha256": hashlib.sha256(prompts.encode("utf-8")).hexdigest(),
+        }
+
+
+    def _path(self, p: StableDiffusionProcessing, x: torch.Tensor) -> Path:
+        # request_id is restricted to [A-Za-z0-9_-] by AnimateDiffProcess._check, the pass is told apart by iteration and latent size
+        directory = (Path(p.outpath_samples) / "AnimateDiff" / "checkpoints").resolve()
+        path = (directory / f"{self.params.request_id}-{p.iteration:03}-{x.shape[-1]}x{x.shape[-2]}.safetensors").resolve()
+        assert path.parent == directory, f"Invalid request_id {self.params.request_id} for checkpoint."
+        return path
+
+
+    def _write(self, path: Path, tensors: dict, metadata: dict):
+        from safetensors.torch import save_file
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_suffix(".tmp")
+        save_file(tensors, str(tmp), metadata)
+        # a crash while writing leaves the previous checkpoint intact
+        os.replace(tmp, path)
+
+
+    def save(self, step: int, x: torch.Tensor):
+        if self.pending is not None and not self.pending.done():
+            logger.debug(f"Skip checkpoint at step {step}, the previous one is still being written.")
+            return
+        metadata = {
+            **self.pass_key,
+            "step": str(step),
+        }
+        tensors = {"latent": x.detach().to("cpu", copy=True).contiguous()}
+        self.owned = True
+        self.pending = AnimateDiffCheckpoint.writer.submit(self._write, self.path, tensors, metadata)
+
+
+    def load(self):
+        if not self.path.exists():
+            return None
+        from safetensors import safe_open
+        with safe_open(str(self.path), framework="pt", device="cpu") as f:
+            metadata = f.metadata() or {}
+            mismatch = [k for k, v in self.pass_key.items() if metadata.get(k, None) != v]
+            if mismatch:
+                logger.warning(f"Ignoring checkpoint {self.path}, it was saved by a different job ({', '.join(mismatch)} differ).")
+                return None
+            return int(metadata["step"]), f.get_tensor("latent")
+
+
+    def finish(self):
+        # the pass is done, its checkpoint can no longer be resumed
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        # only the checkpoint of this pass, a later pass of the job may still resume from its own
+        if self.owned and self.path.exists():
+            self.path.unlink()
+        self.owned = False
+
+
+    def _begin(self, sampler, p: StableDiffusionProcessing, x: torch.Tensor):
+        # returns the original sampler function if this pass resumes from a checkpoint
+        self.p = p
+        self.pass_key = {**self._pass_key(p, x, sampler), **self.job_key}
+        self.path = self._path(p, x)
+        self.step_offset = 0
+        self.owned = False
+        if not self.params.resume:
+            return None
+        func = sampler.func
+        if "sigmas" not in inspect.signature(func).parameters:
+            logger.warning(f"Sampler {sampler.funcname} does not take a sigma schedule, cannot resume from checkpoint.")
+            return None
+        try:
+            checkpoint = self.load()
+        except Exception as e:
+            logger.warning(f"Failed to load checkpoint {self.path}: {e}")
+            return None
+        if checkpoint is None:
+            return None
+        step, latent = checkpoint
+        logger.info(f"Resuming sampling pass {p.iteration} from step {step} of checkpoint {self.path}.")
+        self.step_offset = step
+        self.owned = True
+
+        @functools.wraps(func)
+        def resumed(model, x, *args, sigmas=None, **kwargs):
+            return func(model, latent.to(device=x.device, dtype=x.dtype), *args, sigmas=sigmas[step:], **kwargs)
+
+        sampler.func = resumed
+        return func
+
+
+    def hack(self, p: StableDiffusionProcessing, params: AnimateDiffProcess):
+        self.params = params
+        self.job_key = self._job_key(p, params)
+        if AnimateDiffCheckpoint.get_interval() <= 0 and not params.resume:
+            return
+        if not params.request_id:
+            logger.warning("Checkpoints are keyed by request_id, set it to save or resume checkpoints.")
+            return
+        if AnimateDiffCheckpoint.original_sample is not None:
+            logger.info("KDiffusionSampler already hacked for checkpoints.")
+            return
+
+        logger.info("Hacking KDiffusionSampler to save and resume checkpoints.")
+        from modules.sd_samplers_kdiffusion import KDiffusionSampler
+        AnimateDiffCheckpoint.original_sample = KDiffusionSampler.sample
+        AnimateDiffCheckpoint.original_sample_img2img = KDiffusionSampler.sample_img2img
+        AnimateDiffCheckpoint.original_callback_state = KDiffusionSampler.callback_state
+        original_sample = AnimateDiffCheckpoint.original_sample
+        original_sample_img2img = AnimateDiffCheckpoint.original_sample_img2img
+        original_callback_state = AnimateDiffCheckpoint.original_callback_state
+        checkpoint = self
+
+        def run(sampler, p, x, sample):
+            func = checkpoint._begin(sampler, p, x)
+            try:
+                samples = sample()
+            finally:
+                if func is not None:
+                    sampler.func = func
+            # an interrupted pass returns its last latent, keep the checkpoint to resume later
+            if not shared.state.interrupted:
+                checkpoint.finish()
+            return samples
+
+        def mm_sample(self, p, x, *args, **kwargs):
+            return run(self, p, x, lambda: original_sample(self, p, x, *args, **kwargs))
+
+        def mm_sample_img2img(self, p, x, noise, *args, **kwargs):
+            return run(self, p, x, lambda: original_sample_img2img(self, p, x, noise, *args, **kwargs))
+
+        def mm_callback_state(self, d):
+            # d['x'] is the latent at the start of step d['i'], which is all a sampler needs to continue
+            step = d['i'] + checkpoint.step_offset
+            interval = AnimateDiffCheckpoint.get_interval()
+            if interval > 0 and step > 0 and step % interval == 0:
+                checkpoint.save(step, d['x'])
+            return original_callback_state(self, d)
+
+        KDiffusionSampler.sample = mm_sample
+        KDiffusionSampler.sample_img2img = mm_sample_img2img
+        KDiffusionSampler.callback_state = mm_callback_state
+
+
+    def restore(self):
+        if AnimateDiffCheckpoint.original_sample is None:
+            return
+
+        logger.info("Restoring KDiffusionSampler checkpoint hooks.")
+        if self.pending is not None:
+            self.pending.result()
+            self.pending = None
+        from modules.sd_samplers_kdiffusion import KDiffusionSampler
+        KDiffusionSampler.sample = AnimateDiffCheckpoint.original_sample
+        KDiffusionSampler.sample_img2img = AnimateDiffCheckpoint.original_sample_img2img
+        KDiffusionSampler.callback_state = AnimateDiffCheckpoint.original_callback_state
+        AnimateDiffCheckpoint.original_sample = None
+        AnimateDiffCheckpoint.original_sample_img2img = None
+        AnimateDiffCheckpoint.original_callback_state = None
@@ -100,6 +100,8 @@ class AnimateDiffControl:
                     unit_batch_list.append(len(p.init_images))
 
                 if len(unit_batch_list) > 0:
+                    assert not params.stream, "Streaming mode does not support ControlNet V2V or img2img batch."
+                    assert params.video_count == 1, "More than one video per batch does not support ControlNet V2V or img2img batch."
                     video_length = min(unit_batch_list)
                     # ensure that params.video_length <= video_length and params.batch_size <= video_length
                     if params.video_length > video_length:
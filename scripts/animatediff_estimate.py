@@ -0,0 +1,121 @@
+from types import SimpleNamespace
+
+from modules import shared
+
+from scripts.animatediff_infv2v import AnimateDiffInfV2V
+from scripts.animatediff_ui import AnimateDiffProcess
+
+
+class AnimateDiffEstimate:
+    """
+    Dry run of the context schedule of a job: windows per step, UNet work and a rough peak memory estimate.
+    Nothing is loaded, so it is cheap enough to gate API requests before they are queued.
+    """
+
+    # fp16 UNet + motion module weights in bytes
+    model_bytes = {"SD1.5": 2.6e9, "SDXL": 5.6e9}
+    # activations of one frame in one UNet batch per latent pixel, with memory efficient attention
+    activation_bytes = {"SD1.5": 6.0e4, "SDXL": 3.0e4}
+    # fp32 copies of all latents alive during sampling: sampler state, denoised, cond/uncond inputs and outputs
+    latent_copies = 6
+
+    def __init__(
+        self,
+        params: AnimateDiffProcess,
+        width: int = 512,
+        height: int = 512,
+        steps: int = 20,
+        cfg_scale: float = 7.0,
+        n_iter: int = 1,
+        model_type: str = "SD1.5",
+    ):
+        assert model_type in AnimateDiffEstimate.model_bytes, f"Unknown model type {model_type}, choose one of {list(AnimateDiffEstimate.model_bytes)}."
+        assert width > 0 and height > 0 and steps > 0 and n_iter > 0, "Width, height, steps and n_iter should be positive."
+        self.params = params
+        self.width = width
+        self.height = height
+        self.steps = steps
+        self.cfg_scale = cfg_scale
+        self.n_iter = n_iter
+        self.model_type = model_type
+
+
+    def _uncond_evaluated(self, step: int):
+        # mirrors the uncond skipping of mm_cfg_forward
+        params = self.params
+        if self.cfg_scale == 1.0:
+            return False
+        if params.cfg_cutoff < 1 and step >= params.cfg_cutoff * self.steps:
+            return False
+        if params.uncond_interval > 1 and step >= params.uncond_start:
+            return (step - params.uncond_start) % params.uncond_interval == 0
+        return True
+
+
+    def estimate(self) -> dict:
+        params = self.params
+        p = SimpleNamespace(batch_size=1, n_iter=self.n_iter, do_not_save_samples=False)
+        params.set_p(p)
+
+        video_length = params.batch_size if params.stream else params.video_length
+        windows_per_call = max(1, int(shared.opts.data.get("animatediff_windows_per_call", 1)))
+        prune_threshold = float(shared.opts.data.get("animatediff_prune_threshold", 0)) if shared.opts.data.get("animatediff_prune_windows", False) else -1
+        batch_cond_uncond = shared.opts.batch_cond_uncond
+
+        windows_per_step = []
+        unet_calls = 0
+        frame_evaluations = 0
+        context_frames = 0
+        max_halves = 1
+        for step in range(self.steps):
+            windows = AnimateDiffInfV2V.context_windows(step, video_length, params.batch_size, params.stride, params.overlap, params.closed_loop, prune_threshold)
+            halves = 2 if self._uncond_evaluated(step) else 1
+            max_halves = max(max_halves, halves)
+            windows_per_step.append(len(windows))
+            context_frames += windows.numel()
+            frame_evaluations += windows.numel() * halves * params.video_count
+            calls = -(-len(windows) // windows_per_call)
+            unet_calls += calls if batch_cond_uncond else calls * halves
+
+        latent_pixels = (self.width // 8) * (self.height // 8)
+        unet_batch = min(windows_per_call, max(windows_per_step)) * params.batch_size * params.video_count * (max_halves if batch_cond_uncond else 1)
+        memory = {
+            "model": int(AnimateDiffEstimate.model_bytes[self.model_type]),
+            "latents": int(p.batch_size * 4 * latent_pixels * 4 * AnimateDiffEstimate.latent_copies),
+            "activations": int(unet_batch * latent_pixels * AnimateDiffEstimate.activation_bytes[self.model_type]),
+        }
+        memory["peak"] = sum(memory.values())
+
+        return {
+            "video_length": params.video_length,
+            "videos": params.video_count * p.n_iter,
+            "frames_per_pass": p.batch_size,
+            "passes": p.n_iter,
+            "windows_per_step": windows_per_step,
+            "unet_calls": unet_calls * p.n_iter,
+            "unet_frame_evaluations": frame_evaluations * p.n_iter,
+            "unet_batch_size": unet_batch,
+            # how many times each frame goes through the UNet per step and CFG half, 1 means no overlap
+            "redundancy": context_frames / (self.steps * video_length),
+            "estimated_memory_bytes": memory,
+        }
+
+
+    @staticmethod
+    def on_app_started(_, app):
+        from fastapi import Body, HTTPException
+
+        @app.post("/animatediff/v1/estimate")
+        async def estimate(
+            args: dict = Body({}, title="AnimateDiff parameters, same as alwayson_scripts AnimateDiff args"),
+            width: int = Body(512),
+            height: int = Body(512),
+            steps: int = Body(20),
+            cfg_scale: float = Body(7.0),
+            n_iter: int = Body(1),
+            model_type: str = Body("SD1.5", title="SD1.5 | SDXL"),
+        ):
+            try:
+                return AnimateDiffEstimate(AnimateDiffProcess(**args), width, height, steps, cfg_scale, n_iter, model_type).estimate()
+            except (AssertionError, TypeError) as e:
+                raise HTTPException(status_code=422, detail=str(e))
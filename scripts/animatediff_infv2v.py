@@ -1,16 +1,21 @@
-from typing import List
+from contextlib import contextmanager
+from functools import lru_cache
 
 import numpy as np
 import torch
 
 from modules import prompt_parser, devices, sd_samplers_common, shared
 from modules.shared import opts, state
-from modules.script_callbacks import CFGDenoiserParams, cfg_denoiser_callback
+from modules.script_callbacks import CFGDenoiserParams, cfg_denoiser_callback, callback_map
 from modules.script_callbacks import CFGDenoisedParams, cfg_denoised_callback
 from modules.script_callbacks import AfterCFGCallbackParams, cfg_after_cfg_callback
 from modules.sd_samplers_cfg_denoiser import CFGDenoiser, catenate_conds, subscript_cond, pad_cond
 
+from scripts.animatediff_checkpoint import AnimateDiffCheckpoint
+from scripts.animatediff_infotext import update_infotext
 from scripts.animatediff_logger import logger_animatediff as logger
+from scripts.animatediff_mm import mm_animatediff as motion_module
+from scripts.animatediff_offload import AnimateDiffLatentOffload
 from scripts.animatediff_ui import AnimateDiffProcess
 from scripts.animatediff_prompt import AnimateDiffPromptSchedule
 
@@ -25,71 +30,144 @@ class AnimateDiffInfV2V:
         except:
             self.cn_script = None
         self.prompt_scheduler = prompt_scheduler
+        self.p = p
+        self.pruned_windows = 0
+        self.saved_calls = 0
+        self.oom_guard = AnimateDiffOOMGuard()
+        self.offload = AnimateDiffLatentOffload()
+        self.checkpoint = AnimateDiffCheckpoint()
+        self.convergence = None
 
 
     # Returns fraction that has denominator that is a power of 2
     @staticmethod
     def ordered_halving(val):
-        # get binary value, padded with 0s for 64 bits
-        bin_str = f"{val:064b}"
-        # flip binary value, padding included
-        bin_flip = bin_str[::-1]
-        # convert binary to int
-        as_int = int(bin_flip, 2)
-        # divide by 1 << 64, equivalent to 2**64, or 18446744073709551616,
-        # or b10000000000000000000000000000000000000000000000000000000000000000 (1 with 64 zero's)
-        final = as_int / (1 << 64)
-        return final
+        # reverse the bits of val as a 64-bit integer, then divide by 1 << 64
+        bits = (np.uint64(val) >> np.arange(64, dtype=np.uint64)) & np.uint64(1)
+        as_int = int((bits << np.arange(63, -1, -1, dtype=np.uint64)).sum())
+        return as_int / (1 << 64)
 
 
-    # Generator that returns lists of latent indeces to diffuse on
+    # Returns all contexts of one step as a (num_windows, context) int64 tensor of latent indices to diffuse on.
+    # prune_threshold >= 0 drops redundant windows (see prune_windows), -1 keeps every window.
+    # Results are cached, do not modify the returned tensor in place.
     @staticmethod
-    def uniform(
-        step: int = ...,
-        video_length: int = 0,
+    @lru_cache(maxsize=4096)
+    def context_windows(
+        step: int,
+        video_length: int,
         batch_size: int = 16,
         stride: int = 1,
         overlap: int = 4,
         loop_setting: str = 'R-P',
-    ):
+        prune_threshold: float = -1,
+    ) -> torch.Tensor:
         if video_length <= batch_size:
-            yield list(range(batch_size))
-            return
+            return torch.arange(batch_size, dtype=torch.int64)[None]
 
         closed_loop = (loop_setting == 'A')
         stride = min(stride, int(np.ceil(np.log2(video_length / batch_size))) + 1)
+        halving = AnimateDiffInfV2V.ordered_halving(step)
+        pad = int(round(video_length * halving))
+        levels = []
 
-        for context_step in 1 << np.arange(stride):
-            pad = int(round(video_length * AnimateDiffInfV2V.ordered_halving(step)))
-            both_close_loop = False
-            for j in range(
-                int(AnimateDiffInfV2V.ordered_halving(step) * context_step) + pad,
+        for context_step in (1 << np.arange(stride)).tolist():
+            starts = np.arange(
+                int(halving * context_step) + pad,
                 video_length + pad + (0 if closed_loop else -overlap),
                 (batch_size * context_step - overlap),
-            ):
-                if loop_setting == 'N' and context_step == 1:
-                    current_context = [e % video_length for e in range(j, j + batch_size * context_step, context_step)]
-                    first_context = [e % video_length for e in range(0, batch_size * context_step, context_step)]
-                    last_context = [e % video_length for e in range(video_length - batch_size * context_step, video_length, context_step)]
-                    def get_unsorted_index(lst):
-                        for i in range(1, len(lst)):
-                            if lst[i] < lst[i-1]:
-                                return i
-                        return None
-                    unsorted_index = get_unsorted_index(current_context)
-                    if unsorted_index is None:
-                        yield current_context
-                    elif both_close_loop: # last and this context are close loop
-                        both_close_loop = False
-                        yield first_context
-                    elif unsorted_index < batch_size - overlap: # only this context is close loop
-                        yield last_context
-                        yield first_context
-                    else: # this and next context are close loop
-                        both_close_loop = True
-                        yield last_context
-                else:
-                    yield [e % video_length for e in range(j, j + batch_size * context_step, context_step)]
+            )
+            frames = starts[:, None] + np.arange(batch_size)[None] * context_step
+            if loop_setting == 'N' and context_step == 1:
+                levels.append(np.concatenate(AnimateDiffInfV2V._open_loop_windows(frames, video_length, batch_size, overlap)))
+            else:
+                levels.append(frames % video_length)
+
+        if prune_threshold >= 0:
+            levels = AnimateDiffInfV2V.prune_windows(levels, video_length, prune_threshold)
+        return torch.from_numpy(np.concatenate(levels).astype(np.int64))
+
+
+    # Drop windows of one step that only repeat work. Windows of different strides are never redundant to each other,
+    # except exact duplicates. Within one stride, a window is dropped when every frame is covered by another kept window
+    # and at most threshold of its frames are new to the windows kept before it.
+    @staticmethod
+    def prune_windows(levels: list, video_length: int, threshold: float = 0):
+        seen = set()
+        pruned_levels = []
+        for windows in levels:
+            frames_list = [np.unique(window) for window in windows]
+            counts = np.zeros(video_length, dtype=np.int64)
+            for frames in frames_list:
+                counts[frames] += 1
+            covered = np.zeros(video_length, dtype=bool)
+            kept = []
+            for window, frames in zip(windows, frames_list):
+                key = tuple(window.tolist())
+                new_frames = np.count_nonzero(~covered[frames])
+                if key in seen or ((counts[frames] > 1).all() and new_frames <= threshold * len(frames)):
+                    counts[frames] -= 1
+                    continue
+                seen.add(key)
+                covered[frames] = True
+                kept.append(window)
+            if kept:
+                pruned_levels.append(np.stack(kept))
+        return pruned_levels
+
+
+    # Replace contexts wrapping around the end of the video with the first and / or last context.
+    @staticmethod
+    def _open_loop_windows(frames: np.ndarray, video_length: int, batch_size: int, overlap: int):
+        first_context = np.arange(batch_size)[None] % video_length
+        last_context = np.arange(video_length - batch_size, video_length)[None] % video_length
+        # a context is unsorted at the first frame that wraps around to index 0
+        wraps = (frames[:, 1:] % video_length) == 0
+        if wraps.shape[1] > 0:
+            unsorted_index = np.where(wraps.any(axis=1), wraps.argmax(axis=1) + 1, -1)
+        else: # contexts of one frame never wrap
+            unsorted_index = np.full(len(frames), -1)
+        windows = []
+        both_close_loop = False
+        for current_context, index in zip(frames % video_length, unsorted_index.tolist()):
+            if index < 0:
+                windows.append(current_context[None])
+            elif both_close_loop: # last and this context are close loop
+                both_close_loop = False
+                windows.append(first_context)
+            elif index < batch_size - overlap: # only this context is close loop
+                windows.extend([last_context, first_context])
+            else: # this and next context are close loop
+                both_close_loop = True
+                windows.append(last_context)
+        return windows
+
+
+    # Generator that returns lists of latent indeces to diffuse on
+    @staticmethod
+    def uniform(
+        step: int = ...,
+        video_length: int = 0,
+        batch_size: int = 16,
+        stride: int = 1,
+        overlap: int = 4,
+        loop_setting: str = 'R-P',
+    ):
+        yield from AnimateDiffInfV2V.context_windows(step, video_length, batch_size, stride, overlap, loop_setting).tolist()
+
+
+    # Per-frame weights of one context window when fusing overlapping windows.
+    @staticmethod
+    @lru_cache(maxsize=64)
+    def context_weights(fuse_method: str, context_length: int) -> torch.Tensor:
+        position = torch.arange(context_length, dtype=torch.float32)
+        if fuse_method == "Pyramid":
+            return torch.minimum(position + 1, context_length - position)
+        elif fuse_method == "Gaussian":
+            sigma = max(context_length / 4, 1.0)
+            return torch.exp(-0.5 * ((position - (context_length - 1) / 2) / sigma) ** 2)
+        else: # "Flat"
+            return torch.ones(context_length, dtype=torch.float32)
 
 
     def hack(self, params: AnimateDiffProcess):
@@ -99,74 +177,194 @@ class AnimateDiffInfV2V:
 
         logger.info(f"Hacking CFGDenoiser forward function.")
         AnimateDiffInfV2V.cfg_original_forward = CFGDenoiser.forward
+        motion_module.mm.set_video_count(params.video_count)
         cn_script = self.cn_script
         prompt_scheduler = self.prompt_scheduler
-
-        def mm_cn_select(context: List[int]):
-            # take control images for current context.
-            if cn_script and cn_script.latest_network:
-                from scripts.enums import ControlModelType
-                for control in cn_script.latest_network.control_params:
-                    if control.control_model_type not in [ControlModelType.IPAdapter, ControlModelType.Controlllite]:
-                        if control.hint_cond.shape[0] > len(context):
-                            control.hint_cond_backup = control.hint_cond
-                            control.hint_cond = control.hint_cond[context]
-                        control.hint_cond = control.hint_cond.to(device=devices.get_device_for("controlnet"))
-                        if control.hr_hint_cond is not None:
-                            if control.hr_hint_cond.shape[0] > len(context):
-                                control.hr_hint_cond_backup = control.hr_hint_cond
-                                control.hr_hint_cond = control.hr_hint_cond[context]
-                            control.hr_hint_cond = control.hr_hint_cond.to(device=devices.get_device_for("controlnet"))
-                    # IPAdapter and Controlllite are always on CPU.
-                    elif control.control_model_type == ControlModelType.IPAdapter and control.control_model.image_emb.shape[0] > len(context):
-                        control.control_model.image_emb_backup = control.control_model.image_emb
-                        control.control_model.image_emb = control.control_model.image_emb[context]
-                        control.control_model.uncond_image_emb_backup = control.control_model.uncond_image_emb
-                        control.control_model.uncond_image_emb = control.control_model.uncond_image_emb[context]
-                    elif control.control_model_type == ControlModelType.Controlllite:
-                        for module in control.control_model.modules.values():
-                            if module.cond_image.shape[0] > len(context):
-                                module.cond_image_backup = module.cond_image
-                                module.set_cond_image(module.cond_image[context])
-        
-        def mm_cn_restore(context: List[int]):
-            # restore control images for next context
-            if cn_script and cn_script.latest_network:
-                from scripts.hook import ControlModelType
-                for control in cn_script.latest_network.control_params:
-                    if control.control_model_type not in [ControlModelType.IPAdapter, ControlModelType.Controlllite]:
-                        if getattr(control, "hint_cond_backup", None) is not None:
-                            control.hint_cond_backup[context] = control.hint_cond.to(device="cpu")
-                            control.hint_cond = control.hint_cond_backup
-                        if control.hr_hint_cond is not None and getattr(control, "hr_hint_cond_backup", None) is not None:
-                            control.hr_hint_cond_backup[context] = control.hr_hint_cond.to(device="cpu")
-                            control.hr_hint_cond = control.hr_hint_cond_backup
-                    elif control.control_model_type == ControlModelType.IPAdapter and getattr(control.control_model, "image_emb_backup", None) is not None:
-                        control.control_model.image_emb = control.control_model.image_emb_backup
-                        control.control_model.uncond_image_emb = control.control_model.uncond_image_emb_backup
-                    elif control.control_model_type == ControlModelType.Controlllite:
-                        for module in control.control_model.modules.values():
-                            if getattr(module, "cond_image_backup", None) is not None:
-                                module.set_cond_image(module.cond_image_backup)
+        p = self.p
+        infv2v = self
+
+        cn_cache = AnimateDiffControlCache(cn_script)
+        auto_context = AnimateDiffAutoContext(p, params, cn_script)
+        oom_guard = self.oom_guard
+        offload = self.offload
+        offload.hack()
+        self.checkpoint.hack(p, params)
+        convergence = self.convergence = AnimateDiffConvergence(
+            params.converge_threshold, params.converge_steps, shared.opts.data.get("animatediff_converge_freeze", False))
+        converged_iteration = [None]
+        picard_warned = [False]
+
+        def mm_unet_forward(self, x_in, sigma_in, cond_in, image_cond_in, make_condition_dict, _context, context_length):
+            # each window is its own video, also when several windows share one UNet call
+            motion_module.mm.set_video_length(context_length)
+            with cn_cache.select(_context):
+                return self.inner_model(
+                    # latents offloaded to the CPU are gathered to the device window by window
+                    offload.gather("x_in", x_in, _context, shared.device), sigma_in[_context].to(shared.device),
+                    cond=make_condition_dict(
+                        cond_in[_context] if not isinstance(cond_in, dict) else {k: v[_context] for k, v in cond_in.items()},
+                        image_cond_in[_context]))
 
         def mm_sd_forward(self, x_in, sigma_in, cond_in, image_cond_in, make_condition_dict):
             x_out = torch.zeros_like(x_in)
-            for context in AnimateDiffInfV2V.uniform(self.step, params.video_length, params.batch_size, params.stride, params.overlap, params.closed_loop):
-                if shared.opts.batch_cond_uncond:
-                    _context = context + [c + params.video_length for c in context]
+            # in streaming mode every sampling pass is one chunk of context batch size frames
+            video_length = params.batch_size if params.stream else params.video_length
+            # x_in holds cond, uncond (and image uncond for edit models) of all frames back to back, minus the skipped uncond,
+            # and each of them holds the videos of the batch back to back. Every n_frames rows are one video with the same windows.
+            n_frames = max(video_length, params.batch_size)
+            halves = torch.arange(x_in.shape[0] // n_frames, dtype=torch.int64) * n_frames
+            if params.auto_context:
+                auto_context.select(x_in, len(halves), video_length, lambda n: mm_unet_forward(
+                    self, x_in, sigma_in, cond_in, image_cond_in, make_condition_dict,
+                    (torch.arange(n)[None] + halves[:, None]).flatten(), n))
+            windows_per_call = oom_guard.get_windows_per_call()
+            window_args = (self.step, video_length, params.batch_size, params.stride, params.overlap, params.closed_loop)
+            windows = AnimateDiffInfV2V.context_windows(*window_args)
+            if shared.opts.data.get("animatediff_prune_windows", False):
+                num_windows = len(windows)
+                windows = AnimateDiffInfV2V.context_windows(*window_args, float(shared.opts.data.get("animatediff_prune_threshold", 0)))
+                infv2v.pruned_windows += num_windows - len(windows)
+                infv2v.saved_calls += -(-num_windows // windows_per_call) - -(-len(windows) // windows_per_call)
+            cached = None
+            if convergence.enabled:
+                cache_key, cached = convergence.cached_output(x_in)
+                frozen = convergence.frozen_frames(n_frames) if cached is not None else None
+                if frozen is not None:
+                    # rows of frozen frames keep the output of the previous step unless a refining window covers them
+                    active = ~frozen[windows].all(1)
+                    convergence.frozen_windows += len(windows) - int(active.sum())
+                    windows = windows[active]
+                    x_out = cached.clone()
                 else:
-                    _context = context
-                mm_cn_select(_context)
-                out = self.inner_model(
-                    x_in[_context], sigma_in[_context],
-                    cond=make_condition_dict(
-                        cond_in[_context] if not isinstance(cond_in, dict) else {k: v[_context] for k, v in cond_in.items()},
-                        image_cond_in[_context]))
+                    cached = None
+            fuse_method = shared.opts.data.get("animatediff_context_fuse", "Last window")
+            if fuse_method != "Last window" and len(windows) > 1:
+                # accumulate weighted predictions of overlapping windows in fp32, normalize after the last window
+                x_sum = torch.zeros(x_in.shape, dtype=torch.float32, device=x_in.device)
+                x_weight = torch.zeros((x_in.shape[0],) + (1,) * (x_in.ndim - 1), dtype=torch.float32, device=x_in.device)
+                window_weights = AnimateDiffInfV2V.context_weights(fuse_method, windows.shape[1]).to(x_in.device)
+            else:
+                x_sum = None
+            forward = lambda context, context_length: mm_unet_forward(
+                self, x_in, sigma_in, cond_in, image_cond_in, make_condition_dict, context, context_length)
+            for _contexts, out in oom_guard.run(windows, halves, forward):
                 x_out = x_out.to(dtype=out.dtype)
-                x_out[_context] = out
-                mm_cn_restore(_context)
+                out = out.to(x_out.device)
+                for context, out_context in zip(_contexts, out.split([len(c) for c in _contexts])):
+                    if x_sum is not None:
+                        weight = window_weights.repeat(len(context) // len(window_weights)).view((-1,) + x_weight.shape[1:])
+                        context = context.to(x_in.device)
+                        x_sum.index_add_(0, context, out_context.to(torch.float32) * weight)
+                        x_weight.index_add_(0, context, weight)
+                    else:
+                        x_out[context] = out_context
+            motion_module.mm.set_video_length(None)
+            if x_sum is not None:
+                fused = x_sum / x_weight.clamp_min(1e-8)
+                if cached is not None:
+                    fused = torch.where(x_weight > 0, fused, x_out.to(torch.float32))
+                x_out = fused.to(dtype=x_out.dtype)
+            if convergence.enabled and convergence.freeze:
+                convergence.outputs[cache_key] = x_out
             return x_out
 
+        cfg_indexes = {}
+        cfg_buffers = {}
+
+        def mm_cfg_indexes(conds_list, device):
+            # index tensors for repeating each frame once per composable prompt, and for picking the first cond of each frame
+            key = (tuple(len(conds) for conds in conds_list), tuple(conds[0][0] for conds in conds_list), device)
+            if key not in cfg_indexes:
+                repeats = torch.tensor(key[0], dtype=torch.int64, device=device)
+                cfg_indexes[key] = (
+                    torch.arange(len(conds_list), device=device).repeat_interleave(repeats),
+                    torch.tensor(key[1], dtype=torch.int64, device=device),
+                )
+            return cfg_indexes[key]
+
+        def mm_cfg_assemble(name, head, index, tails):
+            # head[index] followed by tails, written into a buffer reused across steps, only valid until the next step
+            rows = index.shape[0] + sum(tail.shape[0] for tail in tails)
+            shape = (rows,) + tuple(head.shape[1:])
+            buffer = cfg_buffers.get(name, None)
+            if buffer is None or buffer.shape != shape or buffer.dtype != head.dtype or buffer.device != head.device:
+                buffer = cfg_buffers[name] = offload.pin(head.new_empty(shape))
+            # with latent offload, x is on the CPU while image_cond stays on the device
+            torch.index_select(head, 0, index.to(head.device), out=buffer[:index.shape[0]])
+            offset = index.shape[0]
+            for tail in tails:
+                buffer[offset:offset + tail.shape[0]].copy_(tail)
+                offset += tail.shape[0]
+            return buffer
+
+        uncond_cache = {}
+
+        def mm_uncond_cache_hit(x, is_edit_model):
+            # reuse the cached uncond prediction, except at every uncond_interval-th step from uncond_start
+            if params.uncond_interval <= 1 or is_edit_model or state.sampling_step < params.uncond_start:
+                return False
+            eps = uncond_cache.get("eps", None)
+            if eps is None or eps.shape != x.shape or eps.device != x.device:
+                return False
+            return (state.sampling_step - params.uncond_start) % params.uncond_interval != 0
+
+        stream_latents = {}
+        stream = {}
+        stream_iteration = [None]
+
+        def mm_stream_begin(self, x, sigma):
+            # at the first step of a chunk, take the frames shared with the previous chunk from its result
+            stream.clear()
+            starts = params.stream_starts()
+            chunk = p.iteration % len(starts)
+            # the hires fix pass of a chunk runs in the same iteration and must keep the lowres result of that chunk
+            new_iteration = stream_iteration[0] != p.iteration
+            stream_iteration[0] = p.iteration
+            if chunk == 0:
+                if new_iteration:
+                    # a new video starts
+                    stream_latents.clear()
+                return
+            # keyed by latent shape, so the hires fix pass continues from the hires pass of the previous chunk
+            previous = stream_latents.get(tuple(x.shape[1:]), None)
+            if previous is None:
+                return
+            overlap = starts[chunk - 1] + params.batch_size - starts[chunk]
+            init_latent = getattr(self, "init_latent", None)
+            origin = init_latent[:overlap] if init_latent is not None and init_latent.shape == x.shape else 0
+            stream["latent"] = previous[-overlap:]
+            # reuse the initial noise of this chunk to re-noise the shared frames at every step
+            stream["noise"] = (x[:overlap] - origin) / sigma[:overlap].view((-1,) + (1,) * (x.ndim - 1))
+
+        def mm_time_blocks(block_steps, cond, uncond, prompt_closed_loop):
+            # cond and uncond of all frames once per time block, each reconstructed at the sampling step of its block,
+            # conds_list pointing at the rows of each block
+            conds_list, tensors, unconds = [], [], []
+            for step in block_steps:
+                block_conds_list, tensor = prompt_scheduler.reconstruct_cond(cond, step)
+                rows = sum(mm_cond_shape(t)[0] for t in tensors)
+                tensors.append(prompt_scheduler.multi_cond(tensor, prompt_closed_loop, len(block_conds_list) // params.video_count, params.video_count))
+                unconds.append(prompt_parser.reconstruct_cond_batch(uncond, step))
+                conds_list += [[(i + rows, weight) for i, weight in conds] for conds in block_conds_list]
+            return conds_list, mm_cat_blocks(tensors), mm_cat_blocks(unconds)
+
+        def mm_cond_shape(c):
+            return (c["crossattn"] if isinstance(c, dict) else c).shape
+
+        def mm_cat_blocks(conds):
+            # prompt editing can change the token count between steps, pad shorter blocks with the empty prompt
+            longest = max(mm_cond_shape(c)[1] for c in conds)
+            empty = shared.sd_model.cond_stage_model_empty_prompt
+            return catenate_conds([pad_cond(c, (longest - mm_cond_shape(c)[1]) // empty.shape[1], empty) if mm_cond_shape(c)[1] < longest else c for c in conds])
+
+        def mm_cfg_cond_only(cond_scale, is_edit_model, time_blocks):
+            if is_edit_model:
+                return False
+            if cond_scale == 1.0:
+                return True
+            # the time blocks of one Picard call lie on both sides of the cutoff
+            return time_blocks == 1 and params.cfg_cutoff < 1 and state.sampling_step >= params.cfg_cutoff * state.sampling_steps
+
         def mm_cfg_forward(self, x, sigma, uncond, cond, cond_scale, s_min_uncond, image_cond):
             if state.interrupted or state.skipped:
                 raise sd_samplers_common.InterruptedException
@@ -175,20 +373,58 @@ class AnimateDiffInfV2V:
                 cond = self.sampler.sampler_extra_args['cond']
                 uncond = self.sampler.sampler_extra_args['uncond']
 
+            if self.step == 0:
+                uncond_cache.clear()
+                convergence.reset()
+                if converged_iteration[0] != p.iteration:
+                    # a new batch, forget the passes of the previous one
+                    converged_iteration[0] = p.iteration
+                    if params.converged_at:
+                        params.converged_at = ''
+                        update_infotext(p, params)
+            convergence.calls = 0
+
             # at self.image_cfg_scale == 1.0 produced results for edit model are the same as with normal sampling,
             # so is_edit_model is set to False to support AND composition.
             is_edit_model = shared.sd_model.cond_stage_key == "edit" and self.image_cfg_scale is not None and self.image_cfg_scale != 1.0
 
-            conds_list, tensor = prompt_parser.reconstruct_multicond_batch(cond, self.step)
+            uncond_schedule = uncond
+            conds_list, tensor = prompt_scheduler.reconstruct_cond(cond, self.step) # hook
             uncond = prompt_parser.reconstruct_cond_batch(uncond, self.step)
+            prompt_closed_loop = (params.video_length > params.batch_size) and (params.closed_loop in ['R+P', 'A']) # hook
+            tensor = prompt_scheduler.multi_cond(tensor, prompt_closed_loop, len(conds_list) // params.video_count, params.video_count) # hook
+
+            # the Picard sampler evaluates several steps in one call, as copies of all frames back to back
+            frames = len(conds_list)
+            time_blocks = x.shape[0] // frames if x.shape[0] % frames == 0 else 1
+            cn_cache.time_blocks, cn_cache.frames = time_blocks, frames
+            init_latent, mask, nmask = getattr(self, "init_latent", None), self.mask, self.nmask
+            if time_blocks > 1:
+                assert not params.stream, "Streaming mode does not support the Picard sampler."
+                block_steps = getattr(self, "picard_steps", None)
+                assert block_steps is not None and len(block_steps) == time_blocks, "Several steps in one call are only supported for the Picard sampler."
+                if not picard_warned[0] and (params.cfg_cutoff < 1 or params.uncond_interval > 1 or s_min_uncond > 0):
+                    picard_warned[0] = True
+                    logger.warning("CFG cutoff, uncond refresh interval and negative guidance minimum sigma depend on the sampling step, the Picard sampler ignores them.")
+                conds_list, tensor, uncond = mm_time_blocks(block_steps, cond, uncond_schedule, prompt_closed_loop)
+                image_cond = image_cond.repeat((time_blocks,) + (1,) * (image_cond.ndim - 1))
+                init_latent, mask, nmask = [t.repeat((time_blocks,) + (1,) * (t.ndim - 1)) if isinstance(t, torch.Tensor) and t.shape[0] == frames else t for t in (init_latent, mask, nmask)]
 
             assert not is_edit_model or all(len(conds) == 1 for conds in conds_list), "AND is not supported for InstructPix2Pix checkpoint (unless using Image CFG scale = 1.0)"
 
-            if self.mask_before_denoising and self.mask is not None:
-                x = self.init_latent * self.mask + self.nmask * x
+            if params.stream:
+                if self.step == 0:
+                    mm_stream_begin(self, x, sigma)
+                if stream:
+                    overlap = stream["latent"].shape[0]
+                    x = x.clone()
+                    x[:overlap] = stream["latent"] + stream["noise"] * sigma[:overlap].view((-1,) + (1,) * (x.ndim - 1))
+
+            if self.mask_before_denoising and mask is not None:
+                x = init_latent * mask + nmask * x
 
             batch_size = len(conds_list)
-            repeats = [len(conds_list[i]) for i in range(batch_size)]
+            cond_index, denoised_image_indexes = mm_cfg_indexes(conds_list, x.device)
 
             if shared.sd_model.model.conditioning_key == "crossattn-adm":
                 image_uncond = torch.zeros_like(image_cond) # this should not be supported.
@@ -201,14 +437,17 @@ class AnimateDiffInfV2V:
                     make_condition_dict = lambda c_crossattn, c_concat: {"c_crossattn": [c_crossattn], "c_concat": [c_concat]}
 
             if not is_edit_model:
-                x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
-                sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
-                image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond])
+                x_in = mm_cfg_assemble("x_in", x, cond_index, [x])
+                sigma_in = mm_cfg_assemble("sigma_in", sigma, cond_index, [sigma])
+                image_cond_in = mm_cfg_assemble("image_cond_in", image_cond, cond_index, [image_uncond])
             else:
-                x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x] + [x])
-                sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma] + [sigma])
-                image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_uncond] + [torch.zeros_like(self.init_latent)])
+                x_in = mm_cfg_assemble("x_in", x, cond_index, [x, x])
+                sigma_in = mm_cfg_assemble("sigma_in", sigma, cond_index, [sigma, sigma])
+                image_cond_in = mm_cfg_assemble("image_cond_in", image_cond, cond_index, [image_uncond, torch.zeros_like(init_latent)])
 
+            if callback_map["callbacks_cfg_denoiser"]:
+                # extensions may keep the inputs they are given, never hand them the buffers overwritten at the next step
+                x_in, sigma_in, image_cond_in = x_in.clone(), sigma_in.clone(), image_cond_in.clone()
             denoiser_params = CFGDenoiserParams(x_in, image_cond_in, sigma_in, state.sampling_step, state.sampling_steps, tensor, uncond)
             cfg_denoiser_callback(denoiser_params)
             x_in = denoiser_params.x
@@ -219,8 +458,21 @@ class AnimateDiffInfV2V:
             skip_uncond = False
 
             # alternating uncond allows for higher thresholds without the quality loss normally expected from raising it
-            if self.step % 2 and s_min_uncond > 0 and sigma[0] < s_min_uncond and not is_edit_model:
+            if self.step % 2 and s_min_uncond > 0 and sigma[0] < s_min_uncond and not is_edit_model and time_blocks == 1:
+                skip_uncond = True
+
+            # uncond does not change the result at cfg 1, and is dropped after the cfg cutoff
+            if mm_cfg_cond_only(cond_scale, is_edit_model, time_blocks):
+                skip_uncond = True
+                cond_scale = 1.0
+
+            uncond_cached = not skip_uncond and time_blocks == 1 and mm_uncond_cache_hit(x, is_edit_model)
+            if uncond_cached:
                 skip_uncond = True
+                x_uncond_in = x_in[-batch_size:]
+                sigma_uncond_in = sigma_in[-batch_size:]
+
+            if skip_uncond:
                 x_in = x_in[:-batch_size]
                 sigma_in = sigma_in[:-batch_size]
 
@@ -237,8 +489,6 @@ class AnimateDiffInfV2V:
                     self.padded_cond_uncond = True
 
             if tensor.shape[1] == uncond.shape[1] or skip_uncond:
-                prompt_closed_loop = (params.video_length > params.batch_size) and (params.closed_loop in ['R+P', 'A']) # hook
-                tensor = prompt_scheduler.multi_cond(tensor, prompt_closed_loop) # hook
                 if is_edit_model:
                     cond_in = catenate_conds([tensor, uncond, uncond])
                 elif skip_uncond:
@@ -255,26 +505,23 @@ class AnimateDiffInfV2V:
                         b = a + batch_size
                         x_out[a:b] = mm_sd_forward(self, x_in[a:b], sigma_in[a:b], subscript_cond(cond_in, a, b), subscript_cond(image_cond_in, a, b), make_condition_dict) # hook
             else:
+                # cond and uncond token counts differ, so they cannot share a UNet call: run separate windowed passes
                 x_out = torch.zeros_like(x_in)
-                batch_size = batch_size*2 if shared.opts.batch_cond_uncond else batch_size
-                for batch_offset in range(0, tensor.shape[0], batch_size):
-                    a = batch_offset
-                    b = min(a + batch_size, tensor.shape[0])
-
-                    if not is_edit_model:
-                        c_crossattn = subscript_cond(tensor, a, b)
-                    else:
-                        c_crossattn = torch.cat([tensor[a:b]], uncond)
-
-                    x_out[a:b] = self.inner_model(x_in[a:b], sigma_in[a:b], cond=make_condition_dict(c_crossattn, image_cond_in[a:b]))
-
-                if not skip_uncond:
-                    x_out[-uncond.shape[0]:] = self.inner_model(x_in[-uncond.shape[0]:], sigma_in[-uncond.shape[0]:], cond=make_condition_dict(uncond, image_cond_in[-uncond.shape[0]:]))
-
-            denoised_image_indexes = [x[0][0] for x in conds_list]
-            if skip_uncond:
-                fake_uncond = torch.cat([x_out[i:i+1] for i in denoised_image_indexes])
+                a = tensor.shape[0]
+                x_out[:a] = mm_sd_forward(self, x_in[:a], sigma_in[:a], tensor, image_cond_in[:a], make_condition_dict) # hook
+                uncond_in = catenate_conds([uncond] * ((x_in.shape[0] - a) // uncond.shape[0]))
+                x_out[a:] = mm_sd_forward(self, x_in[a:], sigma_in[a:], uncond_in, image_cond_in[a:], make_condition_dict) # hook
+
+            if uncond_cached:
+                # the uncond noise prediction of each frame changes slowly, rescale it by the sigma of this step
+                fake_uncond = x_uncond_in - uncond_cache["eps"] * sigma_uncond_in.view((-1,) + (1,) * (x.ndim - 1))
+                x_out = torch.cat([x_out, fake_uncond.to(dtype=x_out.dtype)])
+            elif skip_uncond:
+                fake_uncond = x_out.index_select(0, denoised_image_indexes)
                 x_out = torch.cat([x_out, fake_uncond])  # we skipped uncond denoising, so we put cond-denoised image to where the uncond-denoised image should be
+            elif params.uncond_interval > 1 and not is_edit_model and time_blocks == 1 and state.sampling_step >= params.uncond_start:
+                sigma_uncond_in = sigma_in[-batch_size:].view((-1,) + (1,) * (x.ndim - 1))
+                uncond_cache["eps"] = (x_in[-batch_size:] - x_out[-batch_size:]) / sigma_uncond_in
 
             denoised_params = CFGDenoisedParams(x_out, state.sampling_step, state.sampling_steps, self.inner_model)
             cfg_denoised_callback(denoised_params)
@@ -283,22 +530,32 @@ class AnimateDiffInfV2V:
 
             if is_edit_model:
                 denoised = self.combine_denoised_for_edit_model(x_out, cond_scale)
-            elif skip_uncond:
+            elif skip_uncond and not uncond_cached:
                 denoised = self.combine_denoised(x_out, conds_list, uncond, 1.0)
             else:
                 denoised = self.combine_denoised(x_out, conds_list, uncond, cond_scale)
 
-            if not self.mask_before_denoising and self.mask is not None:
-                denoised = self.init_latent * self.mask + self.nmask * denoised
+            if not self.mask_before_denoising and mask is not None:
+                denoised = init_latent * mask + nmask * denoised
+
+            if params.stream:
+                if stream:
+                    denoised[:stream["latent"].shape[0]] = stream["latent"]
+                # the prediction of the last step is the result of this chunk
+                stream_latents[tuple(x.shape[1:])] = denoised.detach().clone()
 
-            self.sampler.last_latent = self.get_pred_x0(torch.cat([x_in[i:i + 1] for i in denoised_image_indexes]), torch.cat([x_out[i:i + 1] for i in denoised_image_indexes]), sigma)
+            x_in_denoised = x_in.index_select(0, denoised_image_indexes)
+            self.sampler.last_latent = self.get_pred_x0(x_in_denoised, x_out.index_select(0, denoised_image_indexes), sigma)
+            if time_blocks > 1:
+                # the latest step of a Picard window, in case sampling is interrupted
+                self.sampler.last_latent = self.sampler.last_latent[-frames:]
 
             if opts.live_preview_content == "Prompt":
                 preview = self.sampler.last_latent
             elif opts.live_preview_content == "Negative prompt":
                 preview = self.get_pred_x0(x_in[-uncond.shape[0]:], x_out[-uncond.shape[0]:], sigma)
             else:
-                preview = self.get_pred_x0(torch.cat([x_in[i:i+1] for i in denoised_image_indexes]), torch.cat([denoised[i:i+1] for i in denoised_image_indexes]), sigma)
+                preview = self.get_pred_x0(x_in_denoised, denoised.index_select(0, denoised_image_indexes), sigma)
 
             sd_samplers_common.store_latent(preview)
 
@@ -306,6 +563,17 @@ class AnimateDiffInfV2V:
             cfg_after_cfg_callback(after_cfg_callback_params)
             denoised = after_cfg_callback_params.x
 
+            # the Picard sampler changes several steps per call, convergence is not defined per step there
+            if convergence.enabled and time_blocks == 1 and convergence.update(denoised):
+                steps, total_steps = self.step + 1, getattr(self, "total_steps", state.sampling_steps)
+                if steps < total_steps:
+                    logger.info(f"Sampling converged after {steps} of {total_steps} steps, stopping early.")
+                    params.converged_at = f"{params.converged_at} {steps}/{total_steps}".strip()
+                    update_infotext(p, params)
+                    # the sampler returns last_latent when interrupted, which is the converged prediction
+                    self.sampler.last_latent = denoised
+                    raise sd_samplers_common.InterruptedException
+
             self.step += 1
             return denoised
 
@@ -317,6 +585,327 @@ class AnimateDiffInfV2V:
             logger.info("CFGDenoiser already restored.")
             return
 
+        self.oom_guard.restore()
+        self.checkpoint.restore()
+        self.offload.restore()
+        if self.convergence is not None:
+            self.convergence.restore()
+        if motion_module.mm is not None:
+            motion_module.mm.set_video_count(1)
+        if self.pruned_windows > 0:
+            logger.info(f"Pruned {self.pruned_windows} redundant context windows, saved {self.saved_calls} UNet calls.")
         logger.info(f"Restoring CFGDenoiser forward function.")
         CFGDenoiser.forward = AnimateDiffInfV2V.cfg_original_forward
         AnimateDiffInfV2V.cfg_original_forward = None
+
+
+class AnimateDiffControlCache:
+    """
+    Selects per-frame ControlNet inputs of the current context window.
+    Full hint tensors are copied to the ControlNet device once and each window is taken with index_select,
+    hints that do not fit the memory budget are sliced where they live and only the slice is moved.
+    Hints are read-only, so leaving a window only restores the original references.
+    """
+
+    def __init__(self, cn_script, budget_ratio: float = 0.25):
+        self.cn_script = cn_script
+        self.budget_ratio = budget_ratio
+        self.budget = None
+        self.cached_bytes = 0
+        self.device_tensors = {}
+        self.time_blocks = 1
+        self.frames = 0
+
+
+    def _get_budget(self, device: torch.device):
+        if self.budget is None:
+            if device.type == "cuda":
+                self.budget = int(torch.cuda.mem_get_info(device)[0] * self.budget_ratio)
+            else:
+                self.budget = float("inf")
+        return self.budget
+
+
+    def _on_device(self, tensor: torch.Tensor, device: torch.device):
+        # full copy of tensor on device, or None if it does not fit the budget
+        key = (id(tensor), device)
+        cached = self.device_tensors.get(key, None)
+        if cached is not None and cached[0] is tensor:
+            return cached[1]
+        if tensor.device == device:
+            return tensor
+        nbytes = tensor.numel() * tensor.element_size()
+        if self.cached_bytes + nbytes > self._get_budget(device):
+            return None
+        self.device_tensors[key] = (tensor, tensor.to(device))
+        self.cached_bytes += nbytes
+        return self.device_tensors[key][1]
+
+
+    def _take(self, tensor: torch.Tensor, context: torch.Tensor, device: torch.device, indices: dict):
+        full = self._on_device(tensor, device)
+        if tensor.shape[0] <= 1:
+            return full if full is not None else tensor.to(device)
+        source = full if full is not None else tensor
+        if source.device not in indices:
+            indices[source.device] = context.to(source.device)
+        return source.index_select(0, indices[source.device]).to(device)
+
+
+    @contextmanager
+    def select(self, context: torch.Tensor):
+        if not (self.cn_script and self.cn_script.latest_network):
+            yield
+            return
+
+        from scripts.hook import ControlModelType
+        cn_device = devices.get_device_for("controlnet")
+        if self.time_blocks > 1:
+            # hints hold each frame once per cond / uncond half, the Picard sampler repeats all frames per time block
+            context = context // (self.time_blocks * self.frames) * self.frames + context % self.frames
+        indices = {}
+        restores = []
+        try:
+            for control in self.cn_script.latest_network.control_params:
+                if control.control_model_type not in [ControlModelType.IPAdapter, ControlModelType.Controlllite]:
+                    for attr in ["hint_cond", "hr_hint_cond"]:
+                        hint = getattr(control, attr)
+                        if hint is not None:
+                            restores.append((setattr, control, attr, hint))
+                            setattr(control, attr, self._take(hint, context, cn_device, indices))
+                # IPAdapter and Controlllite are always on CPU.
+                elif control.control_model_type == ControlModelType.IPAdapter:
+                    model = control.control_model
+                    for attr in ["image_emb", "uncond_image_emb"]:
+                        emb = getattr(model, attr)
+                        if emb.shape[0] > 1:
+                            restores.append((setattr, model, attr, emb))
+                            setattr(model, attr, self._take(emb, context, emb.device, indices))
+                elif control.control_model_type == ControlModelType.Controlllite:
+                    for module in control.control_model.modules.values():
+                        if module.cond_image.shape[0] > 1:
+                            restores.append((lambda m, _, v: m.set_cond_image(v), module, None, module.cond_image))
+                            module.set_cond_image(self._take(module.cond_image, context, module.cond_image.device, indices))
+            yield
+        finally:
+            for restore, obj, attr, value in reversed(restores):
+                restore(obj, attr, value)
+
+
+class AnimateDiffAutoContext:
+    """
+    Chooses context batch size and overlap at the first UNet call of jobs with context batch size 0 (auto).
+    Peak memory of one UNet call is fitted as base + per_frame * context frames from two short calibration calls,
+    which covers UNet activations, motion module and ControlNet units. Fits are cached for the session per
+    (model type, motion module, latent size, dtype, CFG halves, ControlNet units). The longest context up to
+    max_len of the motion module that fits the free memory budget is used.
+    """
+    memory_models = {}
+
+    def __init__(self, p, params: AnimateDiffProcess, cn_script, budget_ratio: float = 0.9):
+        self.p = p
+        self.params = params
+        self.cn_script = cn_script
+        self.budget_ratio = budget_ratio
+        self.selected = set()
+
+
+    def _calibrate(self, key, video_length: int, run):
+        if key not in AnimateDiffAutoContext.memory_models:
+            large = max(1, min(motion_module.mm.max_len // 2, video_length))
+            small = max(1, large // 2)
+            peaks = []
+            for frames in dict.fromkeys([small, large]):
+                torch.cuda.synchronize()
+                torch.cuda.reset_peak_memory_stats()
+                allocated = torch.cuda.memory_allocated()
+                run(frames)
+                torch.cuda.synchronize()
+                peaks.append(torch.cuda.max_memory_allocated() - allocated)
+            per_frame = max((peaks[-1] - peaks[0]) / (large - small) if large > small else peaks[-1] / large, 1)
+            base = max(peaks[-1] - per_frame * large, 0)
+            AnimateDiffAutoContext.memory_models[key] = (base, per_frame)
+            logger.info(f"Calibrated UNet call memory: {base / 2**20:.0f} MiB + {per_frame / 2**20:.0f} MiB per context frame.")
+        return AnimateDiffAutoContext.memory_models[key]
+
+
+    def select(self, x_in: torch.Tensor, num_halves: int, video_length: int, run):
+        # once per latent size, so a hires fix pass chooses again
+        shape = tuple(x_in.shape[-2:])
+        # with latent offload x_in is on the CPU, but the UNet and its memory are on the device
+        if shape in self.selected or torch.device(shared.device).type != "cuda":
+            return
+        self.selected.add(shape)
+
+        params = self.params
+        cn_units = len(self.cn_script.latest_network.control_params) if self.cn_script and self.cn_script.latest_network else 0
+        key = (shared.sd_model.is_sdxl, motion_module.mm.mm_hash, shape, devices.dtype_unet, num_halves, cn_units)
+        base, per_frame = self._calibrate(key, video_length, run)
+
+        device = torch.device(shared.device)
+        free = torch.cuda.mem_get_info(device)[0] + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+        windows_per_call = max(1, int(shared.opts.data.get("animatediff_windows_per_call", 1)))
+        fit = int((free * self.budget_ratio - base) // (per_frame * windows_per_call))
+        if fit < 1:
+            logger.warn(f"Not even 1 context frame fits into {free / 2**20:.0f} MiB free memory.")
+        params.batch_size = max(1, min(motion_module.mm.max_len, video_length, fit))
+        if params.auto_overlap:
+            # overlap does not change peak memory, weighted fusion needs less of it to hide seams
+            fuse_method = shared.opts.data.get("animatediff_context_fuse", "Last window")
+            params.overlap = params.batch_size // 4 if fuse_method == "Last window" else max(2, params.batch_size // 8)
+        params.overlap = min(params.overlap, params.batch_size - 1)
+        logger.info(f"Auto context batch size {params.batch_size}, overlap {params.overlap} for {free / 2**20:.0f} MiB free memory.")
+        update_infotext(self.p, params)
+
+
+class AnimateDiffOOMGuard:
+    """
+    Recovers context window UNet calls from device out of memory errors instead of failing the job.
+    Each OOM degrades the job by one level and the window batch is retried: sliced motion module attention first,
+    then separate cond / uncond calls, then halving windows per call. Degradation is kept for the rest of the job.
+    Errors are recognized by type or message, so a stub model raising RuntimeError("out of memory") exercises it on CPU (see tools/check_oom_guard.py).
+    """
+    attention_slice_size = 4096
+
+    def __init__(self):
+        self.sliced_attention = False
+        self.split_halves = False
+        self.windows_per_call = None
+        self.retries = 0
+
+
+    @staticmethod
+    def is_oom(e: Exception):
+        oom_error = getattr(torch.cuda, "OutOfMemoryError", None)
+        return (oom_error is not None and isinstance(e, oom_error)) or (isinstance(e, RuntimeError) and "out of memory" in str(e))
+
+
+    def run(self, windows: torch.Tensor, halves: torch.Tensor, forward):
+        """
+        Runs context windows through forward(rows, context_length) in batches of windows per call, yielding (contexts, out)
+        for every batch: the rows of each window in all halves, and the outputs of those rows back to back.
+        A batch that runs out of memory is retried with the next degradation.
+        """
+        pending = list(windows.split(self.get_windows_per_call())) if len(windows) > 0 else []
+        while pending:
+            windows_batch = pending.pop(0)
+            contexts = [(context[None] + halves[:, None]).flatten() for context in windows_batch]
+            try:
+                if self.split_halves and len(halves) > 1:
+                    # one call per video of each cond / uncond half, reordered to window-major like contexts
+                    outs = [forward((windows_batch + half).flatten(), windows_batch.shape[1]) for half in halves.tolist()]
+                    out = torch.stack(outs).unflatten(1, windows_batch.shape).transpose(0, 1).flatten(0, 2)
+                    del outs
+                else:
+                    out = forward(torch.cat(contexts), windows_batch.shape[1])
+            except Exception as e:
+                if not self.is_oom(e):
+                    raise
+                degraded = self.degrade(len(windows_batch), len(halves))
+                if not degraded:
+                    raise
+            else:
+                degraded = False
+            if degraded:
+                # retry this window batch with the degraded configuration, outside except so the traceback is freed first
+                devices.torch_gc()
+                pending[:0] = list(windows_batch.split(self.get_windows_per_call()))
+                continue
+            yield contexts, out
+
+
+    def get_windows_per_call(self):
+        windows_per_call = max(1, int(shared.opts.data.get("animatediff_windows_per_call", 1)))
+        return windows_per_call if self.windows_per_call is None else min(windows_per_call, self.windows_per_call)
+
+
+    def degrade(self, windows_per_call: int, num_halves: int):
+        # returns False when there is nothing left to degrade
+        if not self.sliced_attention and motion_module.mm is not None:
+            self.sliced_attention = True
+            motion_module.mm.set_attention_slice(AnimateDiffOOMGuard.attention_slice_size)
+            action = "slicing motion module attention"
+        elif not self.split_halves and num_halves > 1:
+            self.split_halves = True
+            action = "running cond and uncond in separate UNet calls"
+        elif windows_per_call > 1:
+            self.windows_per_call = windows_per_call // 2
+            action = f"reducing windows per call to {self.windows_per_call}"
+        else:
+            logger.error(f"Out of memory in context window after {self.retries} retries, nothing left to degrade.")
+            return False
+        self.retries += 1
+        logger.warn(f"Out of memory in context window, retry {self.retries} by {action}.")
+        return True
+
+
+    def restore(self):
+        if self.sliced_attention and motion_module.mm is not None:
+            motion_module.mm.set_attention_slice(None)
+        if self.retries > 0:
+            logger.info(
+                f"Recovered from {self.retries} out of memory errors. Sliced attention: {self.sliced_attention}, "
+                f"separate cond / uncond: {self.split_halves}, windows per call: {self.get_windows_per_call()}.")
+
+
+class AnimateDiffConvergence:
+    """
+    Stops a sampling pass once the denoised prediction of every frame has stopped changing.
+    The change of a frame is the L2 distance between its denoised predictions of consecutive steps, relative to the
+    previous one. A frame has converged when its change stays below threshold for `patience` consecutive steps, and a
+    context window has converged when all of its frames have. Steps are counted in denoiser calls, which is one call
+    per step for Euler, DPM++ 2M, LCM and DDIM. With freeze, converged windows are no longer sent to the UNet and
+    their rows keep the model output of the previous step, while the other windows keep refining.
+    """
+
+    def __init__(self, threshold: float, patience: int, freeze: bool = False):
+        self.threshold = threshold
+        self.patience = patience
+        self.freeze = freeze
+        self.frozen_windows = 0
+        self.reset()
+
+
+    @property
+    def enabled(self):
+        return self.threshold > 0
+
+
+    def reset(self):
+        self.previous = None
+        self.counts = None
+        self.outputs = {}
+        self.calls = 0
+
+
+    def update(self, denoised: torch.Tensor):
+        # returns True when every frame has converged
+        current = denoised.detach().flatten(1).to(torch.float32, copy=True)
+        if self.previous is None or self.previous.shape != current.shape:
+            self.counts = torch.zeros(current.shape[0], dtype=torch.int64, device=current.device)
+        else:
+            change = (current - self.previous).norm(dim=1) / self.previous.norm(dim=1).clamp_min(1e-8)
+            self.counts = torch.where(change < self.threshold, self.counts + 1, torch.zeros_like(self.counts))
+        self.previous = current
+        return bool((self.counts >= self.patience).all())
+
+
+    def frozen_frames(self, n_frames: int):
+        # bool mask of the frames converged in every video of the batch, None if no frame is frozen
+        if not self.freeze or self.counts is None or self.counts.shape[0] % n_frames != 0:
+            return None
+        frozen = (self.counts >= self.patience).view(-1, n_frames).all(0).cpu()
+        return frozen if frozen.any() else None
+
+
+    def cached_output(self, x_in: torch.Tensor):
+        # model output of the same call in the previous step, CFG may call mm_sd_forward several times per step
+        key = (self.calls, tuple(x_in.shape))
+        self.calls += 1
+        return key, self.outputs.get(key, None)
+
+
+    def restore(self):
+        self.reset()
+        if self.frozen_windows > 0:
+            logger.info(f"Froze {self.frozen_windows} converged context windows.")
@@ -14,6 +14,16 @@ class AnimateDiffI2VLatent:
     def randomize(
         self, p: StableDiffusionProcessingImg2Img, params: AnimateDiffProcess
     ):
+        # In streaming mode, p.init_latent only holds the frames of the current chunk
+        if params.stream:
+            starts = params.stream_starts()
+            start = starts[p.iteration % len(starts)]
+            chunk = slice(start, start + params.batch_size)
+        else:
+            chunk = slice(None)
+        # the alphas of one video, repeated for every video of the batch
+        tile = lambda alpha: alpha.repeat(params.video_count, 1, 1, 1) if params.video_count > 1 else alpha
+
         # Get init_alpha
         init_alpha = [
             1 - pow(i, params.latent_power) / params.latent_scale
@@ -75,10 +85,12 @@ class AnimateDiffI2VLatent:
                     mode="bilinear",
                 )
             # Modify init_latent
+            init_alpha, last_alpha = tile(init_alpha[chunk]), tile(last_alpha[chunk])
             p.init_latent = (
                 p.init_latent * init_alpha
                 + last_latent * last_alpha
                 + p.rng.next() * (1 - init_alpha - last_alpha)
             )
         else:
+            init_alpha = tile(init_alpha[chunk])
             p.init_latent = p.init_latent * init_alpha + p.rng.next() * (1 - init_alpha)
@@ -1,20 +1,74 @@
 import os
 import re
 import sys
+from collections import OrderedDict
+
+import torch
 
 from modules import sd_models, shared
 from modules.paths import extensions_builtin_dir
 
 from scripts.animatediff_logger import logger_animatediff as logger
+from scripts.animatediff_mm import mm_animatediff as motion_module
 
 sys.path.append(f"{extensions_builtin_dir}/Lora")
 
 class AnimateDiffLora:
     original_load_network = None
+    lora_cache = OrderedDict()
+    lora_cache_size = 4
+    # keys of files that are not motion LoRAs, only keys are kept so this LRU can be larger
+    non_mm_loras = OrderedDict()
+    non_mm_loras_size = 64
+    # pre-merge state lives on the class, so a job that failed before postprocess_batch is undone by the next job
+    merged_weights = {}
+    merged_modules = []
 
     def __init__(self, v2: bool):
         self.v2 = v2
 
+
+    @staticmethod
+    def convert_mm_name_to_compvis(key):
+        sd_module_key, _, network_part = re.split(r'(_lora\.)', key)
+        sd_module_key = sd_module_key.replace("processor.", "").replace("to_out", "to_out.0")
+        return sd_module_key, 'lora_' + network_part
+
+
+    @staticmethod
+    def read_mm_lora(filename: str, mm_hash: str):
+        """
+        Return {compvis key: (network key, {lora part: weight})} for a motion LoRA, or None if the file is not a motion LoRA.
+        Resolved mappings are cached by (path, mtime, motion module hash), so repeated jobs skip reading and key conversion.
+        """
+        cache_key = (filename, os.path.getmtime(filename), mm_hash)
+        if cache_key in AnimateDiffLora.non_mm_loras:
+            AnimateDiffLora.non_mm_loras.move_to_end(cache_key)
+            return None
+        if cache_key in AnimateDiffLora.lora_cache:
+            AnimateDiffLora.lora_cache.move_to_end(cache_key)
+            return AnimateDiffLora.lora_cache[cache_key]
+
+        sd = sd_models.read_state_dict(filename)
+        if 'motion_modules' not in list(sd.keys())[0]:
+            AnimateDiffLora.non_mm_loras[cache_key] = None
+            while len(AnimateDiffLora.non_mm_loras) > AnimateDiffLora.non_mm_loras_size:
+                AnimateDiffLora.non_mm_loras.popitem(last=False)
+            return None
+
+        mapping = {}
+        for key_network, weight in sd.items():
+            key, network_part = AnimateDiffLora.convert_mm_name_to_compvis(key_network)
+            if key not in mapping:
+                mapping[key] = (key_network, {})
+            mapping[key][1][network_part] = weight
+
+        AnimateDiffLora.lora_cache[cache_key] = mapping
+        while len(AnimateDiffLora.lora_cache) > AnimateDiffLora.lora_cache_size:
+            AnimateDiffLora.lora_cache.popitem(last=False)
+        return mapping
+
+
     def hack(self):
         if not self.v2:
             return
@@ -30,47 +84,75 @@ class AnimateDiffLora:
         original_load_network = AnimateDiffLora.original_load_network
 
         def mm_load_network(name, network_on_disk):
+            mm_hash = motion_module.mm.mm_hash if motion_module.mm is not None else None
+            mapping = AnimateDiffLora.read_mm_lora(network_on_disk.filename, mm_hash)
+            if mapping is None:
+                return original_load_network(name, network_on_disk)
 
-            def convert_mm_name_to_compvis(key):
-                sd_module_key, _, network_part = re.split(r'(_lora\.)', key)
-                sd_module_key = sd_module_key.replace("processor.", "").replace("to_out", "to_out.0")
-                return sd_module_key, 'lora_' + network_part
-
+            logger.info(f"Loading motion LoRA {name} from {network_on_disk.filename}")
             net = network.Network(name, network_on_disk)
             net.mtime = os.path.getmtime(network_on_disk.filename)
+            net.is_mm_lora = True
 
-            sd = sd_models.read_state_dict(network_on_disk.filename)
-            
-            if 'motion_modules' in list(sd.keys())[0]:
-                logger.info(f"Loading motion LoRA {name} from {network_on_disk.filename}")
-                matched_networks = {}
+            for key, (key_network, w) in mapping.items():
+                sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+                assert sd_module is not None, f"Failed to find sd module for key {key}."
+                weights = network.NetworkWeights(network_key=key_network, sd_key=key, w=dict(w), sd_module=sd_module)
+                net_module = networks.module_types[0].create_module(net, weights)
+                assert net_module is not None, "Failed to create motion module LoRA"
+                net.modules[key] = net_module
 
-                for key_network, weight in sd.items():
-                    key, network_part = convert_mm_name_to_compvis(key_network)
-                    sd_module = shared.sd_model.network_layer_mapping.get(key, None)
+            return net
 
-                    assert sd_module is not None, f"Failed to find sd module for key {key}."
+        networks.load_network = mm_load_network
 
-                    if key not in matched_networks:
-                        matched_networks[key] = network.NetworkWeights(
-                            network_key=key_network, sd_key=key, w={}, sd_module=sd_module)
 
-                    matched_networks[key].w[network_part] = weight
+    def merge(self):
+        """
+        Pre-merge loaded motion LoRA deltas into the motion module weights, keeping a backup to undo it.
+        The merged LoRA modules are detached from their networks so that they are not applied again on forward.
+        """
+        if not self.v2 or not shared.opts.data.get("animatediff_lora_premerge", False):
+            return
 
-                for key, weights in matched_networks.items():
-                    net_module = networks.module_types[0].create_module(net, weights)
-                    assert net_module is not None, "Failed to create motion module LoRA"
-                    net.modules[key] = net_module
+        import networks
+        self.unmerge()
+        with torch.no_grad():
+            for net in networks.loaded_networks:
+                if not getattr(net, "is_mm_lora", False):
+                    continue
+                logger.info(f"Pre-merging motion LoRA {net.name} into motion module.")
+                for key, net_module in list(net.modules.items()):
+                    sd_module = net_module.sd_module
+                    if sd_module not in AnimateDiffLora.merged_weights:
+                        AnimateDiffLora.merged_weights[sd_module] = sd_module.weight.detach().clone()
+                    updown, _ = net_module.calc_updown(sd_module.weight.to(dtype=torch.float32))
+                    sd_module.weight.copy_((sd_module.weight.to(dtype=torch.float32) + updown.to(sd_module.weight.device)).to(sd_module.weight.dtype))
+                    AnimateDiffLora.merged_modules.append((net, key, net.modules.pop(key)))
+            for sd_module in AnimateDiffLora.merged_weights:
+                sd_module.network_weights_backup = None
+                sd_module.network_current_names = ()
+
+
+    def unmerge(self):
+        if not AnimateDiffLora.merged_weights and not AnimateDiffLora.merged_modules:
+            return
 
-                return net
-            else:
-                del sd
-                return original_load_network(name, network_on_disk)
+        logger.info("Restoring motion module weights from pre-merged motion LoRA.")
+        with torch.no_grad():
+            for sd_module, weight in AnimateDiffLora.merged_weights.items():
+                sd_module.weight.copy_(weight)
+                sd_module.network_weights_backup = None
+                sd_module.network_current_names = ()
+        for net, key, net_module in AnimateDiffLora.merged_modules:
+            net.modules[key] = net_module
+        AnimateDiffLora.merged_weights = {}
+        AnimateDiffLora.merged_modules = []
 
-        networks.load_network = mm_load_network
 
-    
     def restore(self):
+        # also undoes a merge left by a v2 motion module of an earlier job
+        self.unmerge()
         if not self.v2:
             return
 
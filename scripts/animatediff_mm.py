@@ -1,5 +1,6 @@
 import gc
 import os
+import time
 
 import torch
 from einops import rearrange
@@ -18,6 +19,9 @@ class AnimateDiffMM:
         self.script_dir = None
         self.prev_alpha_cumprod = None
         self.gn32_original_forward = None
+        self.mm_host_cache = None
+        # True only while the weights live in the host cache after unload, the cache is stale once they are back on device
+        self.mm_offloaded = False
 
 
     def set_script_dir(self, script_dir):
@@ -43,14 +47,25 @@ class AnimateDiffMM:
             raise RuntimeError("Please download models manually.")
         if self.mm is None or self.mm.mm_name != model_name:
             logger.info(f"Loading motion module {model_name} from {model_path}")
+            metadata = self._read_metadata(model_path)
+            # the hash of the file itself, WebUI caches it after the first load
             model_hash = hashes.sha256(model_path, f"AnimateDiff/{model_name}")
             mm_state_dict = sd_models.read_state_dict(model_path)
-            model_type = MotionModuleType.get_mm_type(mm_state_dict)
-            logger.info(f"Guessed {model_name} architecture: {model_type}")
+            model_type = MotionModuleType.from_metadata(metadata)
+            if model_type is None:
+                model_type = MotionModuleType.get_mm_type(mm_state_dict)
+                logger.info(f"Guessed {model_name} architecture: {model_type}")
+            else:
+                logger.info(f"Read {model_name} architecture from metadata: {model_type}")
             self.mm = MotionWrapper(model_name, model_hash, model_type)
+            # written by tools/convert_motion_module.py, the model this file was converted from
+            self.mm.source_hash = metadata.get("animatediff_source_sha256", None)
             missed_keys = self.mm.load_state_dict(mm_state_dict)
             logger.warn(f"Missing keys {missed_keys}")
-        self.mm.to(device).eval()
+            self.mm_host_cache = None
+            self.mm_offloaded = False
+        self._upload()
+        self.mm.eval()
         if not shared.cmd_opts.no_half:
             self.mm.half()
             if getattr(devices, "fp8", False):
@@ -59,6 +74,15 @@ class AnimateDiffMM:
                         module.to(torch.float8_e4m3fn)
 
 
+    @staticmethod
+    def _read_metadata(model_path: str):
+        if not model_path.endswith(".safetensors"):
+            return {}
+        from safetensors import safe_open
+        with safe_open(model_path, framework="pt", device="cpu") as f:
+            return f.metadata() or {}
+
+
     def inject(self, sd_model, model_name="mm_sd_v15.ckpt"):
         if AnimateDiffMM.mm_injected:
             logger.info("Motion module already injected. Trying to restore.")
@@ -81,11 +105,13 @@ class AnimateDiffMM:
                 from ldm.modules.diffusionmodules.util import GroupNorm32
             self.gn32_original_forward = GroupNorm32.forward
             gn32_original_forward = self.gn32_original_forward
+            mm = self.mm
 
             def groupnorm32_mm_forward(self, x):
-                x = rearrange(x, "(b f) c h w -> b c f h w", b=2)
+                b = x.shape[0] // mm.video_length if mm.video_length else 2 * mm.video_count
+                x = rearrange(x, "(b f) c h w -> b c f h w", b=b)
                 x = gn32_original_forward(self, x)
-                x = rearrange(x, "b c f h w -> (b f) c h w", b=2)
+                x = rearrange(x, "b c f h w -> (b f) c h w", b=b)
                 return x
 
             GroupNorm32.forward = groupnorm32_mm_forward
@@ -191,10 +217,37 @@ class AnimateDiffMM:
         self.prev_alpha_cumprod = None
 
 
+    def _use_host_cache(self):
+        return shared.opts.data.get("animatediff_pin_memory", True) and torch.cuda.is_available() and device.type == "cuda"
+
+
+    def _upload(self):
+        start = time.perf_counter()
+        if self.mm_offloaded and self.mm_host_cache is not None and self._use_host_cache() and self.mm_host_cache.matches(self.mm):
+            self.mm_host_cache.upload(device)
+            method = "pinned host cache"
+        else:
+            # a no-op for weights already on device, which may carry in-place changes such as a merged motion LoRA
+            self.mm.to(device)
+            method = "module.to"
+        self.mm_offloaded = False
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+        logger.info(f"Motion module uploaded to {device} via {method} in {time.perf_counter() - start:.3f}s.")
+
+
     def unload(self):
         logger.info("Moving motion module to CPU")
         if self.mm is not None:
-            self.mm.to(cpu)
+            start = time.perf_counter()
+            if self._use_host_cache():
+                if self.mm_host_cache is None or not self.mm_host_cache.matches(self.mm):
+                    self.mm_host_cache = MotionHostCache(self.mm)
+                self.mm_host_cache.offload()
+                self.mm_offloaded = True
+            else:
+                self.mm.to(cpu)
+            logger.info(f"Motion module moved to CPU in {time.perf_counter() - start:.3f}s.")
         torch_gc()
         gc.collect()
 
@@ -203,8 +256,62 @@ class AnimateDiffMM:
         logger.info("Removing motion module from any memory")
         del self.mm
         self.mm = None
+        self.mm_host_cache = None
+        self.mm_offloaded = False
         torch_gc()
         gc.collect()
 
 
+class MotionHostCache:
+    """
+    Keeps the CPU copy of motion module weights in one pinned, contiguous buffer per dtype,
+    with every parameter and buffer of the module being a view into it while offloaded.
+    Uploading is then one large non-blocking copy per dtype instead of one synchronous copy per tensor.
+    """
+
+    def __init__(self, mm: MotionWrapper):
+        self.layout = {}
+        self.flat = {}
+        for tensor in self._tensors(mm):
+            entries = self.layout.setdefault(tensor.dtype, [])
+            offset = entries[-1][1] + entries[-1][2].numel() if entries else 0
+            entries.append((tensor, offset, tensor.shape))
+        for dtype, entries in self.layout.items():
+            numel = entries[-1][1] + entries[-1][2].numel()
+            self.flat[dtype] = torch.empty(numel, dtype=dtype, device=cpu).pin_memory()
+        self.signature = self._signature(mm)
+
+
+    @staticmethod
+    def _tensors(mm: MotionWrapper):
+        yield from mm.parameters()
+        yield from (buffer for buffer in mm.buffers() if buffer is not None)
+
+
+    @staticmethod
+    def _signature(mm: MotionWrapper):
+        return [(tensor.dtype, tuple(tensor.shape)) for tensor in MotionHostCache._tensors(mm)]
+
+
+    def matches(self, mm: MotionWrapper):
+        return self.signature == self._signature(mm)
+
+
+    def _rebind(self, flat: dict):
+        for dtype, entries in self.layout.items():
+            for tensor, offset, shape in entries:
+                tensor.data = flat[dtype][offset:offset + shape.numel()].view(shape)
+
+
+    def offload(self):
+        for dtype, entries in self.layout.items():
+            for tensor, offset, shape in entries:
+                self.flat[dtype][offset:offset + shape.numel()].copy_(tensor.data.reshape(-1))
+        self._rebind(self.flat)
+
+
+    def upload(self, target_device: torch.device):
+        self._rebind({dtype: flat.to(target_device, non_blocking=True) for dtype, flat in self.flat.items()})
+
+
 mm_animatediff = AnimateDiffMM()
@@ -0,0 +1,154 @@
+from contextlib import contextmanager
+
+import torch
+
+from modules import devices, shared
+
+from scripts.animatediff_logger import logger_animatediff as logger
+
+
+class AnimateDiffOffloadRNG:
+    """
+    WebUI image RNG that hands out noise on the CPU, for ancestral and SDE samplers working on offloaded latents.
+    """
+
+    def __init__(self, rng, offload):
+        self.rng = rng
+        self.offload = offload
+
+
+    def next(self):
+        return self.offload.to_host(self.rng.next())
+
+
+    def __getattr__(self, name):
+        return getattr(self.rng, name)
+
+
+class AnimateDiffLatentOffload:
+    """
+    Keeps the sampler state of all frames (latents, sigmas, CFG inputs and outputs) in CPU memory during sampling.
+    Only the frames of the context windows of one UNet call are gathered to the device, and the results are copied back,
+    so device memory scales with the context batch size instead of the number of frames.
+    CPU tensors are pinned when CUDA is available, so that windows are copied to the device without blocking.
+    """
+
+    original_sample = None
+    original_sample_img2img = None
+    original_get_sigmas = None
+
+    def __init__(self):
+        self.active = False
+        self.staging = {}
+
+
+    @staticmethod
+    def enabled():
+        return shared.opts.data.get("animatediff_latent_offload", False)
+
+
+    def pin(self, tensor: torch.Tensor):
+        if self.active and tensor.device.type == "cpu" and torch.cuda.is_available() and not tensor.is_pinned():
+            return tensor.pin_memory()
+        return tensor
+
+
+    def to_host(self, tensor: torch.Tensor):
+        return self.pin(tensor.to("cpu")) if tensor.device.type != "cpu" else tensor
+
+
+    def gather(self, name: str, tensor: torch.Tensor, index: torch.Tensor, device: torch.device):
+        # rows of a CPU tensor on device, through a pinned staging buffer reused across calls.
+        # Calls can follow each other without a sync in between (e.g. separate cond / uncond calls of the OOM guard),
+        # so the host waits for the copy out of the buffer to finish before it is overwritten.
+        if tensor.device == device or tensor.device.type != "cpu":
+            return tensor[index]
+        shape = (index.shape[0],) + tuple(tensor.shape[1:])
+        buffer, copied = self.staging.get(name, (None, None))
+        if buffer is None or buffer.shape != shape or buffer.dtype != tensor.dtype:
+            buffer, copied = self.pin(tensor.new_empty(shape)), None
+        if copied is not None:
+            copied.synchronize()
+        torch.index_select(tensor, 0, index.to(tensor.device), out=buffer)
+        out = buffer.to(device, non_blocking=buffer.is_pinned())
+        if buffer.is_pinned() and out.device.type == "cuda":
+            copied = torch.cuda.Event()
+            copied.record()
+        else:
+            copied = None
+        self.staging[name] = (buffer, copied)
+        return out
+
+
+    @contextmanager
+    def offloaded(self, p):
+        rng, mask, nmask = getattr(p, "rng", None), getattr(p, "mask", None), getattr(p, "nmask", None)
+        self.active = True
+        try:
+            if rng is not None:
+                p.rng = AnimateDiffOffloadRNG(rng, self)
+            if isinstance(mask, torch.Tensor):
+                p.mask = self.to_host(mask)
+            if isinstance(nmask, torch.Tensor):
+                p.nmask = self.to_host(nmask)
+            yield
+        finally:
+            self.active = False
+            self.staging.clear()
+            if rng is not None:
+                p.rng = rng
+            if isinstance(mask, torch.Tensor):
+                p.mask = mask
+            if isinstance(nmask, torch.Tensor):
+                p.nmask = nmask
+
+
+    def hack(self):
+        if not AnimateDiffLatentOffload.enabled():
+            return
+        if AnimateDiffLatentOffload.original_sample is not None:
+            logger.info("KDiffusionSampler already hacked for latent offload.")
+            return
+
+        logger.info("Hacking KDiffusionSampler to keep latents in CPU memory.")
+        from modules.sd_samplers_kdiffusion import KDiffusionSampler
+        AnimateDiffLatentOffload.original_sample = KDiffusionSampler.sample
+        AnimateDiffLatentOffload.original_sample_img2img = KDiffusionSampler.sample_img2img
+        AnimateDiffLatentOffload.original_get_sigmas = KDiffusionSampler.get_sigmas
+        original_sample = AnimateDiffLatentOffload.original_sample
+        original_sample_img2img = AnimateDiffLatentOffload.original_sample_img2img
+        original_get_sigmas = AnimateDiffLatentOffload.original_get_sigmas
+        offload = self
+
+        def mm_sample(self, p, x, *args, **kwargs):
+            with offload.offloaded(p):
+                samples = original_sample(self, p, offload.to_host(x), *args, **kwargs)
+            return samples.to(shared.device)
+
+        def mm_sample_img2img(self, p, x, noise, *args, **kwargs):
+            with offload.offloaded(p):
+                samples = original_sample_img2img(self, p, offload.to_host(x), offload.to_host(noise), *args, **kwargs)
+            return samples.to(shared.device)
+
+        def mm_get_sigmas(self, p, steps):
+            sigmas = original_get_sigmas(self, p, steps)
+            return sigmas.cpu() if offload.active else sigmas
+
+        KDiffusionSampler.sample = mm_sample
+        KDiffusionSampler.sample_img2img = mm_sample_img2img
+        KDiffusionSampler.get_sigmas = mm_get_sigmas
+
+
+    def restore(self):
+        if AnimateDiffLatentOffload.original_sample is None:
+            return
+
+        logger.info("Restoring KDiffusionSampler.")
+        from modules.sd_samplers_kdiffusion import KDiffusionSampler
+        KDiffusionSampler.sample = AnimateDiffLatentOffload.original_sample
+        KDiffusionSampler.sample_img2img = AnimateDiffLatentOffload.original_sample_img2img
+        KDiffusionSampler.get_sigmas = AnimateDiffLatentOffload.original_get_sigmas
+        AnimateDiffLatentOffload.original_sample = None
+        AnimateDiffLatentOffload.original_sample_img2img = None
+        AnimateDiffLatentOffload.original_get_sigmas = None
+        devices.torch_gc()
@@ -22,11 +22,17 @@ class AnimateDiffOutput:
         date = datetime.datetime.now().strftime('%Y-%m-%d')
         output_dir = Path(f"{p.outpath_samples}/AnimateDiff/{date}")
         output_dir.mkdir(parents=True, exist_ok=True)
+        # frames of each video are consecutive, also when several videos share one sampling batch
         step = params.video_length if params.video_length > params.batch_size else params.batch_size
+        if params.stream:
+            step = params.batch_size * len(params.stream_starts())
         for i in range(res.index_of_first_image, len(res.images), step):
             # frame interpolation replaces video_list with interpolated frames
             # so make a copy instead of a slice (reference), to avoid modifying res
-            frame_list = [image.copy() for image in res.images[i : i + params.video_length]]
+            if params.stream:
+                frame_list = [image.copy() for image in self._stream_frames(params, res.images[i : i + step])]
+            else:
+                frame_list = [image.copy() for image in res.images[i : i + params.video_length]]
 
             seq = images.get_next_sequence_number(output_dir, "")
             filename_suffix = f"-{params.request_id}" if params.request_id else ""
@@ -46,6 +52,16 @@ class AnimateDiffOutput:
             res.images = video_paths if not p.is_api else (self._encode_video_to_b64(video_paths) + (frame_list if 'Frame' in params.format else []))
 
 
+    def _stream_frames(self, params: AnimateDiffProcess, chunk_list: list):
+        # each chunk after the first repeats the frames it shares with the previous chunk
+        starts = params.stream_starts()
+        frame_list = chunk_list[:params.batch_size]
+        for chunk in range(1, len(starts)):
+            overlap = starts[chunk - 1] + params.batch_size - starts[chunk]
+            frame_list += chunk_list[chunk * params.batch_size + overlap : (chunk + 1) * params.batch_size]
+        return frame_list
+
+
     def _add_reverse(self, params: AnimateDiffProcess, frame_list: list):
         if params.video_length <= params.batch_size and params.closed_loop in ['A']:
             frame_list_reverse = frame_list[::-1]
@@ -0,0 +1,122 @@
+import time
+
+import torch
+from tqdm.auto import trange
+
+# WebUI is imported where it is used, so that sample_picard runs on CPU with a stub denoiser without WebUI (see tools/bench_picard.py).
+
+
+@torch.no_grad()
+def sample_picard(model, x, sigmas, extra_args=None, callback=None, disable=None, window=4, tolerance=0.1, stats=None, on_call=None):
+    """
+    Parallel-in-time Euler sampling with Picard iterations (ParaDiGMS).
+    The denoiser is evaluated at `window` consecutive steps in one call, the steps are stacked as copies of x back to back.
+    Every iteration recomputes the trajectory in the window from the cumulative Euler drifts, and the window slides past
+    the steps whose change is within `tolerance` (relative to the noise the step removes). With window 1 this is Euler.
+    Approaches the result of sequential Euler as tolerance goes to 0, in fewer but larger model calls. The saving grows
+    with the number of steps, and only pays off if the device has capacity to spare for the larger calls.
+    on_call, if given, is called with the sampling step of each stacked copy before every model call.
+    """
+    extra_args = {} if extra_args is None else extra_args
+    steps = len(sigmas) - 1
+    window = max(1, min(window, steps))
+    s_in = x.new_ones([x.shape[0]])
+    started = time.perf_counter()
+    # estimates of x at sigmas[begin], ..., sigmas[begin + window], the first one is exact
+    xs = [x] * (window + 1)
+    begin, calls, evaluations = 0, 0, 0
+    progress = trange(steps, disable=disable)
+    while begin < steps:
+        size = min(window, steps - begin)
+        step_sigmas = sigmas[begin:begin + size + 1]
+        if on_call is not None:
+            on_call(list(range(begin, begin + size)))
+        denoised = model(torch.cat(xs[:size]), torch.cat([sigma * s_in for sigma in step_sigmas[:-1]]), **extra_args).chunk(size)
+        calls += 1
+        evaluations += size
+
+        trajectory = [xs[0]]
+        for j in range(size):
+            d = (xs[j] - denoised[j]) / step_sigmas[j]
+            trajectory.append(trajectory[-1] + d * (step_sigmas[j + 1] - step_sigmas[j]))
+
+        # x at begin + 1 only depends on the exact x at begin, later steps are accepted while they stop changing,
+        # measured against the noise variance the step removes
+        stride = 1
+        while stride < size:
+            error = (trajectory[stride + 1] - xs[stride + 1]).float().pow(2).mean().item()
+            if error > tolerance ** 2 * max(step_sigmas[stride].item() ** 2 - step_sigmas[stride + 1].item() ** 2, 1e-8):
+                break
+            stride += 1
+
+        if callback is not None:
+            for j in range(stride):
+                callback({'x': trajectory[j], 'i': begin + j, 'sigma': step_sigmas[j], 'sigma_hat': step_sigmas[j], 'denoised': denoised[j]})
+        progress.update(stride)
+        begin += stride
+        xs = trajectory[stride:]
+        xs += [xs[-1]] * (window + 1 - len(xs))
+    progress.close()
+
+    if stats is not None:
+        stats.update(steps=steps, calls=calls, evaluations=evaluations, seconds=time.perf_counter() - started)
+    return xs[0]
+
+
+def sample_picard_webui(model, x, sigmas, extra_args=None, callback=None, disable=None):
+    from modules import shared
+    from scripts.animatediff_logger import logger_animatediff as logger
+    from scripts.animatediff_infv2v import AnimateDiffInfV2V
+    window = int(shared.opts.data.get("animatediff_picard_window", 4))
+    if AnimateDiffInfV2V.cfg_original_forward is None:
+        # only the AnimateDiff CFG path takes several steps in one call, otherwise this is Euler
+        logger.warning("Picard sampler runs in parallel only when AnimateDiff is enabled, falling back to Euler.")
+        window = 1
+    stats = {}
+
+    def on_call(steps):
+        # mm_cfg_forward builds prompts (prompt editing) of each stacked copy at its own step
+        model.picard_steps = steps
+
+    try:
+        x = sample_picard(
+            model, x, sigmas, extra_args, callback, disable,
+            window=window,
+            tolerance=float(shared.opts.data.get("animatediff_picard_tolerance", 0.1)),
+            stats=stats,
+            on_call=on_call,
+        )
+    finally:
+        model.picard_steps = None
+    logger.info(
+        f"Picard sampling: {stats['steps']} steps in {stats['calls']} parallel calls and {stats['seconds']:.1f}s, "
+        f"{stats['evaluations']} model evaluations ({stats['evaluations'] / stats['steps']:.2f}x sequential).")
+    return x
+
+
+class AnimateDiffPicard:
+    picard_ui_injected = False
+
+
+    @staticmethod
+    def hack_kdiff_ui():
+        from modules import shared
+        from scripts.animatediff_logger import logger_animatediff as logger
+        if not shared.opts.data.get("animatediff_enable_picard", False):
+            return
+
+        if AnimateDiffPicard.picard_ui_injected:
+            logger.info(f"Picard sampler already injected.")
+            return
+
+        logger.info(f"Injecting Picard sampler to UI.")
+        from modules import sd_samplers, sd_samplers_common, sd_samplers_kdiffusion
+        samplers_picard = [('Picard (AnimateDiff)', sample_picard_webui, ['k_picard'], {})]
+        samplers_data_picard = [
+            sd_samplers_common.SamplerData(label, lambda model, funcname=funcname: sd_samplers_kdiffusion.KDiffusionSampler(funcname, model), aliases, options)
+            for label, funcname, aliases, options in samplers_picard
+        ]
+        sd_samplers.all_samplers.extend(samplers_data_picard)
+        sd_samplers.all_samplers_map = {x.name: x for x in sd_samplers.all_samplers}
+        sd_samplers.set_samplers()
+        AnimateDiffPicard.picard_ui_injected = True
@@ -1,6 +1,7 @@
 import re
 import torch
 
+from modules import prompt_parser
 from modules.processing import StableDiffusionProcessing, Processed
 
 from scripts.animatediff_logger import logger_animatediff as logger
@@ -12,6 +13,10 @@ class AnimateDiffPromptSchedule:
     def __init__(self):
         self.prompt_map = None
         self.original_prompt = None
+        self.interpolate = True
+        self.schedule_cache = {}
+        self.index_cache = {}
+        self.cond_cache = {}
 
 
     def save_infotext_img(self, p: StableDiffusionProcessing):
@@ -75,71 +80,136 @@ class AnimateDiffPromptSchedule:
                 last_frame = frame
                 current_prompt = f"{', '.join(data['head_prompts'])}, {prompt}, {', '.join(data['tail_prompts'])}"
                 self.prompt_map[frame] = current_prompt
-            prompt_list += [current_prompt for _ in range(last_frame, p.batch_size)]
-            assert len(prompt_list) == p.batch_size, f"prompt_list length {len(prompt_list)} != batch_size {p.batch_size}"
+            total_frames = params.video_length if params.stream else p.batch_size // params.video_count
+            prompt_list += [current_prompt for _ in range(last_frame, total_frames)]
+            assert len(prompt_list) == total_frames, f"prompt_list length {len(prompt_list)} != number of frames {total_frames}"
             self.original_prompt = p.prompt
-            p.prompt = prompt_list * p.n_iter
-
-
-    def single_cond(self, center_frame, video_length: int, cond: torch.Tensor, closed_loop = False):
-        if closed_loop:
-            key_prev = list(self.prompt_map.keys())[-1]
-            key_next = list(self.prompt_map.keys())[0]
-        else:
-            key_prev = list(self.prompt_map.keys())[0]
-            key_next = list(self.prompt_map.keys())[-1]
-
-        for p in self.prompt_map.keys():
-            if p > center_frame:
-                key_next = p
-                break
-            key_prev = p
-
-        dist_prev = center_frame - key_prev
-        if dist_prev < 0:
-            dist_prev += video_length
-        dist_next = key_next - center_frame
-        if dist_next < 0:
-            dist_next += video_length
-
-        if key_prev == key_next or dist_prev + dist_next == 0:
-            return cond[key_prev] if isinstance(cond, torch.Tensor) else {k: v[key_prev] for k, v in cond.items()}
-
-        rate = dist_prev / (dist_prev + dist_next)
-        if isinstance(cond, torch.Tensor):
-            return AnimateDiffPromptSchedule.slerp(cond[key_prev], cond[key_next], rate)
-        else: # isinstance(cond, dict)
-            return {
-                k: AnimateDiffPromptSchedule.slerp(v[key_prev], v[key_next], rate)
-                for k, v in cond.items()
-            }
-    
-
-    def multi_cond(self, cond: torch.Tensor, closed_loop = False):
-        if self.prompt_map is None:
-            return cond
-        cond_list = [] if isinstance(cond, torch.Tensor) else {k: [] for k in cond.keys()}
-        for i in range(cond.shape[0]):
-            single_cond = self.single_cond(i, cond.shape[0], cond, closed_loop)
-            if isinstance(cond, torch.Tensor):
-                cond_list.append(single_cond)
+            if params.stream:
+                # chunks only see their own frames, so each frame keeps the prompt of its last keyframe
+                self.interpolate = False
+                starts = params.stream_starts()
+                prompt_list = [prompt for start in starts for prompt in prompt_list[start:start + p.batch_size]]
+                p.prompt = prompt_list * (p.n_iter // len(starts))
             else:
-                for k, v in single_cond.items():
-                    cond_list[k].append(v)
+                # every video of the batch travels through the same prompts
+                p.prompt = prompt_list * params.video_count * p.n_iter
+
+
+    def compile_schedule(self, video_length: int, closed_loop = False):
+        """
+        Return per-frame (key_prev, key_next, rate) tensors of the prompt map, computed once per video length and loop setting.
+        """
+        cache_key = (video_length, closed_loop)
+        if cache_key in self.schedule_cache:
+            return self.schedule_cache[cache_key]
+
+        keys = list(self.prompt_map.keys())
+        prev_list, next_list, rate_list = [], [], []
+        for center_frame in range(video_length):
+            if closed_loop:
+                key_prev, key_next = keys[-1], keys[0]
+            else:
+                key_prev, key_next = keys[0], keys[-1]
+
+            for p in keys:
+                if p > center_frame:
+                    key_next = p
+                    break
+                key_prev = p
+
+            dist_prev = center_frame - key_prev
+            if dist_prev < 0:
+                dist_prev += video_length
+            dist_next = key_next - center_frame
+            if dist_next < 0:
+                dist_next += video_length
+
+            if key_prev == key_next or dist_prev + dist_next == 0:
+                key_next, rate = key_prev, 0.0
+            else:
+                rate = dist_prev / (dist_prev + dist_next)
+            prev_list.append(key_prev)
+            next_list.append(key_next)
+            rate_list.append(rate)
+
+        schedule = (
+            torch.tensor(prev_list, dtype=torch.int64),
+            torch.tensor(next_list, dtype=torch.int64),
+            torch.tensor(rate_list, dtype=torch.float32),
+        )
+        self.schedule_cache[cache_key] = schedule
+        return schedule
+
+
+    def _interpolate(self, cond: torch.Tensor, video_length: int, closed_loop = False):
+        cache_key = (video_length, closed_loop, cond.shape[0], cond.device)
+        if cache_key not in self.index_cache:
+            key_prev, key_next, rate = self.compile_schedule(video_length, closed_loop)
+            if cond.shape[0] != video_length:
+                # cond only holds the rows of keyframes, in prompt map order
+                positions = torch.zeros(video_length, dtype=torch.int64)
+                positions[list(self.prompt_map.keys())] = torch.arange(len(self.prompt_map))
+                key_prev, key_next = positions[key_prev], positions[key_next]
+            self.index_cache[cache_key] = (key_prev.to(cond.device), key_next.to(cond.device), rate.to(cond.device))
+        key_prev, key_next, rate = self.index_cache[cache_key]
+        return AnimateDiffPromptSchedule.slerp(cond.index_select(0, key_prev), cond.index_select(0, key_next), rate.to(cond.dtype))
+
+
+    def reconstruct_cond(self, cond: prompt_parser.MulticondLearnedConditioning, step: int):
+        """
+        Same as prompt_parser.reconstruct_multicond_batch, but with prompt travel only the rows of keyframes are reconstructed.
+        multi_cond expands them to all frames. Falls back to all rows with AND composition.
+        """
+        keys = list(self.prompt_map.keys()) if self.prompt_map is not None and self.interpolate else []
+        if not keys or keys[-1] >= len(cond.batch) or any(len(composables) != 1 for composables in cond.batch):
+            return prompt_parser.reconstruct_multicond_batch(cond, step)
+
+        conds_list = [[(i, composables[0].weight)] for i, composables in enumerate(cond.batch)]
+        keyframe_cond = prompt_parser.MulticondLearnedConditioning(shape=(len(keys),), batch=[cond.batch[k] for k in keys])
+        _, tensor = prompt_parser.reconstruct_multicond_batch(keyframe_cond, step)
+        return conds_list, tensor
+
+
+    def multi_cond(self, cond: torch.Tensor, closed_loop = False, video_length: int = None, video_count: int = 1):
+        if self.prompt_map is None or not self.interpolate:
+            return cond
+
+        # cond is rebuilt every step, but its content only changes when prompt editing switches prompts
+        tensors = [cond] if isinstance(cond, torch.Tensor) else list(cond.values())
+        if video_length is None or tensors[0].shape[0] != len(self.prompt_map):
+            # all rows are reconstructed, and all videos of the batch share them: interpolate the first video
+            video_length = tensors[0].shape[0] // video_count
+            if video_count > 1:
+                cond = cond[:video_length] if isinstance(cond, torch.Tensor) else {k: v[:video_length] for k, v in cond.items()}
+        cached = self.cond_cache.get((video_length, closed_loop, video_count), None)
+        if cached is not None and len(cached[0]) == len(tensors) and all(
+            a is b or (a.shape == b.shape and a.device == b.device and torch.equal(a, b)) for a, b in zip(cached[0], tensors)
+        ):
+            return cached[1]
+
+        repeat = lambda v: v.repeat((video_count,) + (1,) * (v.ndim - 1)) if video_count > 1 else v
         if isinstance(cond, torch.Tensor):
-            return torch.stack(cond_list).to(cond.dtype).to(cond.device)
+            result = repeat(self._interpolate(cond, video_length, closed_loop))
         else:
-            return {k: torch.stack(v).to(cond[k].dtype).to(cond[k].device) for k, v in cond_list.items()}
+            result = {k: repeat(self._interpolate(v, video_length, closed_loop)) for k, v in cond.items()}
+        self.cond_cache[(video_length, closed_loop, video_count)] = (tensors, result)
+        return result
 
 
     @staticmethod
     def slerp(
-        v0: torch.Tensor, v1: torch.Tensor, t: float, DOT_THRESHOLD: float = 0.9995
+        v0: torch.Tensor, v1: torch.Tensor, t: torch.Tensor, DOT_THRESHOLD: float = 0.9995
     ) -> torch.Tensor:
-        u0 = v0 / v0.norm()
-        u1 = v1 / v1.norm()
-        dot = (u0 * u1).sum()
-        if dot.abs() > DOT_THRESHOLD:
-            return (1.0 - t) * v0 + t * v1
-        omega = dot.acos()
-        return (((1.0 - t) * omega).sin() * v0 + (t * omega).sin() * v1) / omega.sin()
+        """
+        Batched spherical interpolation between v0[i] and v1[i] at t[i], each frame normalized over all its elements.
+        Falls back to linear interpolation where the two are almost parallel.
+        """
+        shape = (-1,) + (1,) * (v0.ndim - 1)
+        t = t.view(shape)
+        u0 = v0 / v0.flatten(1).norm(dim=1).view(shape)
+        u1 = v1 / v1.flatten(1).norm(dim=1).view(shape)
+        dot = (u0 * u1).flatten(1).sum(dim=1).view(shape)
+        lerp = (1.0 - t) * v0 + t * v1
+        omega = dot.clamp(-1, 1).acos()
+        slerp = (((1.0 - t) * omega).sin() * v0 + (t * omega).sin() * v1) / omega.sin()
+        return torch.where(dot.abs() > DOT_THRESHOLD, lerp, slerp)
@@ -1,4 +1,5 @@
 import os
+import re
 
 import cv2
 import gradio as gr
@@ -9,6 +10,7 @@ from modules.processing import StableDiffusionProcessing
 from scripts.animatediff_mm import mm_animatediff as motion_module
 from scripts.animatediff_i2ibatch import animatediff_i2ibatch
 from scripts.animatediff_lcm import AnimateDiffLCM
+from scripts.animatediff_picard import AnimateDiffPicard
 
 
 class ToolButton(gr.Button, gr.components.FormComponent):
@@ -46,6 +48,14 @@ class AnimateDiffProcess:
         latent_power_last=1,
         latent_scale_last=32,
         request_id = '',
+        cfg_cutoff=1.0,
+        uncond_interval=1,
+        uncond_start=0,
+        stream=False,
+        video_count=1,
+        resume=False,
+        converge_threshold=0.0,
+        converge_steps=2,
     ):
         self.model = model
         self.enable = enable
@@ -67,15 +77,28 @@ class AnimateDiffProcess:
         self.latent_power_last = latent_power_last
         self.latent_scale_last = latent_scale_last
         self.request_id = request_id
+        self.cfg_cutoff = cfg_cutoff
+        self.uncond_interval = uncond_interval
+        self.uncond_start = uncond_start
+        self.stream = stream
+        self.video_count = video_count
+        self.resume = resume
+        self.converge_threshold = converge_threshold
+        self.converge_steps = converge_steps
 
 
     def get_list(self, is_img2img: bool):
-        list_var = list(vars(self).values())[:-1]
         if is_img2img:
             animatediff_i2ibatch.hack()
-        else:
-            list_var = list_var[:-5]
-        return list_var
+        return [getattr(self, field) for field in self.get_fields(is_img2img)]
+
+
+    def get_fields(self, is_img2img: bool):
+        # request_id and resume are API only
+        remove = ["request_id", "resume"]
+        if not is_img2img:
+            remove.extend(["latent_power", "latent_scale", "last_frame", "latent_power_last", "latent_scale_last"])
+        return [field for field in vars(self) if field not in remove]
 
 
     def get_dict(self, is_img2img: bool):
@@ -92,10 +115,26 @@ class AnimateDiffProcess:
             "interp": self.interp,
             "interp_x": self.interp_x,
         }
+        if self.cfg_cutoff < 1:
+            infotext['cfg_cutoff'] = self.cfg_cutoff
+        if self.uncond_interval > 1:
+            infotext['uncond_interval'] = self.uncond_interval
+            infotext['uncond_start'] = self.uncond_start
+        if self.stream:
+            infotext['stream'] = self.stream
+        if self.video_count > 1:
+            infotext['video_count'] = self.video_count
+        if self.converge_threshold > 0:
+            infotext['converge_threshold'] = self.converge_threshold
+            infotext['converge_steps'] = self.converge_steps
+            if self.converged_at:
+                infotext['converged_at'] = self.converged_at
         if self.request_id:
             infotext['request_id'] = self.request_id
         if motion_module.mm is not None and motion_module.mm.mm_hash is not None:
             infotext['mm_hash'] = motion_module.mm.mm_hash[:8]
+            if motion_module.mm.source_hash is not None:
+                infotext['mm_source_hash'] = motion_module.mm.source_hash[:8]
         if is_img2img:
             infotext.update({
                 "latent_power": self.latent_power,
@@ -108,7 +147,7 @@ class AnimateDiffProcess:
 
 
     def get_param_names(self, is_img2img: bool):
-        remove = ["format", "request_id", "video_source", "video_path", "last_frame"]
+        remove = ["format", "request_id", "resume", "video_source", "video_path", "last_frame"]
         if not is_img2img:
             remove.extend(["latent_power", "latent_power_last", "latent_scale", "latent_scale_last"])
         
@@ -123,13 +162,44 @@ class AnimateDiffProcess:
         assert (
             self.video_length >= 0 and self.fps > 0
         ), "Video length and FPS should be positive."
+        assert self.batch_size >= 0, "Context batch size should not be negative, 0 means auto."
         assert not set(["GIF", "MP4", "PNG", "WEBP", "WEBM"]).isdisjoint(
             self.format
         ), "At least one saving format should be selected."
+        assert 0 <= self.cfg_cutoff <= 1, "CFG cutoff should be between 0 and 1."
+        assert (
+            self.uncond_interval >= 1 and self.uncond_start >= 0
+        ), "Uncond refresh interval should be positive and uncond cache start step should not be negative."
+        assert self.video_count >= 1, "Videos per batch should be positive."
+        # request_id names output and checkpoint files, reject anything that could leave the output directory
+        assert not self.request_id or re.fullmatch(
+            r"[A-Za-z0-9_-]+", str(self.request_id)
+        ), "request_id may only contain letters, digits, '_' and '-'."
+        assert not (self.stream and self.video_count > 1), "Streaming mode does not support more than one video per batch."
+        assert (
+            self.converge_threshold >= 0 and self.converge_steps >= 1
+        ), "Convergence threshold should not be negative and convergence steps should be positive."
+
+
+    def stream_starts(self):
+        """
+        First frame of each chunk in streaming mode. Chunks advance by (context batch size - overlap),
+        the last chunk is moved back to end at the last frame.
+        """
+        step = self.batch_size - self.overlap
+        chunks = 1 + max(0, -(-(self.video_length - self.batch_size) // step))
+        return [min(i * step, self.video_length - self.batch_size) for i in range(chunks)]
 
 
     def set_p(self, p: StableDiffusionProcessing):
         self._check()
+        # context batch size 0 is auto: start from the longest context of the motion module,
+        # AnimateDiffAutoContext shrinks it at the first step if it does not fit into memory
+        self.auto_context = self.batch_size == 0
+        self.auto_overlap = self.overlap == -1
+        if self.auto_context:
+            max_len = motion_module.mm.max_len if motion_module.mm is not None else 16
+            self.batch_size = min(max_len, self.video_length) if self.video_length > 0 else max_len
         if self.video_length < self.batch_size:
             p.batch_size = self.batch_size
         else:
@@ -141,6 +211,21 @@ class AnimateDiffProcess:
             self.video_default = False
         if self.overlap == -1:
             self.overlap = self.batch_size // 4
+        if self.stream:
+            if self.video_length > self.batch_size:
+                assert self.overlap < self.batch_size, "Overlap should be smaller than context batch size in streaming mode."
+                p.batch_size = self.batch_size
+                p.n_iter = p.n_iter * len(self.stream_starts())
+            else:
+                self.stream = False
+        if self.stream:
+            # chunks are fixed before sampling
+            self.auto_context = False
+        if self.video_count > 1:
+            # videos are laid out back to back in the sampling batch, each one gets its own range of seeds
+            p.batch_size = p.batch_size * self.video_count
+        # sampling steps actually run by each sampling pass of the current batch, filled when a pass converges early
+        self.converged_at = ''
         if "PNG" not in self.format or shared.opts.data.get("animatediff_save_to_custom", False):
             p.do_not_save_samples = True
 
@@ -224,10 +309,10 @@ class AnimateDiffUiGroup:
                     elem_id=f"{elemid_prefix}closed-loop",
                 )
                 self.params.batch_size = gr.Slider(
-                    minimum=1,
+                    minimum=0,
                     maximum=32,
                     value=self.params.batch_size,
-                    label="Context batch size",
+                    label="Context batch size (0 = auto)",
                     step=1,
                     precision=0,
                     elem_id=f"{elemid_prefix}batch-size",
@@ -257,6 +342,55 @@ class AnimateDiffUiGroup:
                     value=self.params.interp_x, label="Interp X", precision=0, 
                     elem_id=f"{elemid_prefix}interp-x"
                 )
+            with gr.Row():
+                self.params.cfg_cutoff = gr.Slider(
+                    minimum=0,
+                    maximum=1,
+                    value=self.params.cfg_cutoff,
+                    step=0.05,
+                    label="CFG cutoff",
+                    elem_id=f"{elemid_prefix}cfg-cutoff",
+                )
+                self.params.uncond_interval = gr.Number(
+                    minimum=1,
+                    value=self.params.uncond_interval,
+                    label="Uncond refresh interval",
+                    precision=0,
+                    elem_id=f"{elemid_prefix}uncond-interval",
+                )
+                self.params.uncond_start = gr.Number(
+                    minimum=0,
+                    value=self.params.uncond_start,
+                    label="Uncond cache start step",
+                    precision=0,
+                    elem_id=f"{elemid_prefix}uncond-start",
+                )
+                self.params.stream = gr.Checkbox(
+                    value=self.params.stream,
+                    label="Streaming (denoise window by window)",
+                    elem_id=f"{elemid_prefix}stream",
+                )
+                self.params.video_count = gr.Number(
+                    minimum=1,
+                    value=self.params.video_count,
+                    label="Videos per batch",
+                    precision=0,
+                    elem_id=f"{elemid_prefix}video-count",
+                )
+            with gr.Row():
+                self.params.converge_threshold = gr.Number(
+                    minimum=0,
+                    value=self.params.converge_threshold,
+                    label="Convergence threshold (0: off)",
+                    elem_id=f"{elemid_prefix}converge-threshold",
+                )
+                self.params.converge_steps = gr.Number(
+                    minimum=1,
+                    value=self.params.converge_steps,
+                    label="Convergence steps",
+                    precision=0,
+                    elem_id=f"{elemid_prefix}converge-steps",
+                )
             self.params.video_source = gr.Video(
                 value=self.params.video_source,
                 label="Video source",
@@ -336,12 +470,14 @@ class AnimateDiffUiGroup:
 
     def register_unit(self, is_img2img: bool):
         unit = gr.State(value=AnimateDiffProcess)
+        fields = self.params.get_fields(is_img2img)
         (
             AnimateDiffUiGroup.img2img_submit_button
             if is_img2img
             else AnimateDiffUiGroup.txt2img_submit_button
         ).click(
-            fn=AnimateDiffProcess,
+            # request_id and resume are not UI inputs but come before later parameters, pass every value by name
+            fn=lambda *values: AnimateDiffProcess(**dict(zip(fields, values))),
             inputs=self.params.get_list(is_img2img),
             outputs=unit,
             queue=False,
@@ -365,3 +501,4 @@ class AnimateDiffUiGroup:
     @staticmethod
     def on_before_ui():
         AnimateDiffLCM.hack_kdiff_ui()
+        AnimateDiffPicard.hack_kdiff_ui()
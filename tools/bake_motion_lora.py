@@ -0,0 +1,77 @@
+"""
+Bake motion LoRAs into a motion module checkpoint.
+
+Example:
+    python tools/bake_motion_lora.py model/mm_sd_v15_v2.ckpt model/mm_sd_v15_v2_panleft.safetensors \
+        --lora models/Lora/v2_lora_PanLeft.ckpt:0.8 --lora models/Lora/v2_lora_ZoomIn.ckpt:0.5
+
+Runs on CPU and does not require WebUI to be running, only a WebUI checkout (see --webui-dir).
+"""
+import argparse
+import os
+
+import mm_common
+
+
+def parse_lora(value: str):
+    path, _, strength = value.rpartition(":")
+    if not path or os.path.exists(value):
+        return value, 1.0
+    return path, float(strength)
+
+
+def bake(mm, lora_path: str, strength: float):
+    import torch
+
+    lora = mm_common.load_state_dict(lora_path)
+    assert 'motion_modules' in list(lora.keys())[0], f"{lora_path} is not a motion LoRA."
+    weights = {}
+    for key_network, weight in lora.items():
+        key, network_part = mm_common.convert_mm_name_to_compvis(key_network)
+        weights.setdefault(key, {})[network_part] = weight
+
+    modules = dict(mm.named_modules())
+    with torch.no_grad():
+        for key, w in weights.items():
+            assert key in modules, f"Failed to find motion module layer for key {key}."
+            weight = modules[key].weight
+            up = w["lora_up.weight"].to(torch.float32)
+            down = w["lora_down.weight"].to(torch.float32)
+            scale = w["lora_alpha"].item() / down.shape[0] if "lora_alpha" in w else 1.0
+            updown = (up.flatten(1) @ down.flatten(1)).reshape(weight.shape)
+            weight.copy_((weight.to(torch.float32) + updown * scale * strength).to(weight.dtype))
+    return len(weights)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Bake motion LoRAs into a motion module checkpoint.")
+    parser.add_argument("base", help="motion module to bake LoRAs into")
+    parser.add_argument("output", help="output .safetensors path")
+    parser.add_argument("--lora", action="append", required=True, metavar="PATH[:STRENGTH]", help="motion LoRA and its strength (default 1.0), may be repeated")
+    parser.add_argument("--precision", choices=["fp16", "bf16", "fp32"], default="fp16")
+    parser.add_argument("--webui-dir", default=None, help="path to stable-diffusion-webui (default: two levels above this extension)")
+    args = parser.parse_args()
+    loras = [parse_lora(lora) for lora in args.lora]
+
+    mm_common.setup_webui(args.webui_dir)
+    base_hash = mm_common.sha256(args.base)
+    # a converted or baked base keeps pointing at the model it came from
+    source_hash = mm_common.read_metadata(args.base).get("animatediff_source_sha256", None) or base_hash
+    mm = mm_common.build_motion_module(args.base, base_hash)
+    print(f"Loaded {args.base} as {mm.mm_type.name}.")
+
+    lora_metadata = []
+    for lora_path, strength in loras:
+        layers = bake(mm, lora_path, strength)
+        print(f"Baked {lora_path} at strength {strength} into {layers} layers.")
+        lora_metadata.append({"name": os.path.basename(lora_path), "sha256": mm_common.sha256(lora_path), "strength": strength})
+
+    mm_common.save_motion_module(mm, args.output, args.precision, {
+        "animatediff_source_sha256": source_hash,
+        "loras": lora_metadata,
+    })
+    print(f"Saved {args.output}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+"""
+Microbenchmark of per-step CFG input assembly in mm_cfg_forward against frame count.
+
+Compares the former per-frame torch.stack / torch.cat comprehensions with index_select into reused buffers,
+and with the copies made for extensions registered on cfg_denoiser_callback.
+Only needs torch, e.g.:
+    python tools/bench_cfg_assembly.py --device cuda --frames 16 32 64 128
+"""
+import argparse
+import time
+
+import torch
+
+
+def legacy(x, sigma, image_cond, repeats, denoised_image_indexes):
+    x_in = torch.cat([torch.stack([x[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [x])
+    sigma_in = torch.cat([torch.stack([sigma[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [sigma])
+    image_cond_in = torch.cat([torch.stack([image_cond[i] for _ in range(n)]) for i, n in enumerate(repeats)] + [image_cond])
+    last = torch.cat([x_in[i:i + 1] for i in denoised_image_indexes])
+    return x_in, sigma_in, image_cond_in, last
+
+
+def assemble(buffers, name, head, index, tails):
+    rows = index.shape[0] + sum(tail.shape[0] for tail in tails)
+    shape = (rows,) + tuple(head.shape[1:])
+    buffer = buffers.get(name, None)
+    if buffer is None or buffer.shape != shape:
+        buffer = buffers[name] = head.new_empty(shape)
+    torch.index_select(head, 0, index, out=buffer[:index.shape[0]])
+    offset = index.shape[0]
+    for tail in tails:
+        buffer[offset:offset + tail.shape[0]].copy_(tail)
+        offset += tail.shape[0]
+    return buffer
+
+
+def vectorized(buffers, x, sigma, image_cond, cond_index, denoised_image_indexes):
+    x_in = assemble(buffers, "x_in", x, cond_index, [x])
+    sigma_in = assemble(buffers, "sigma_in", sigma, cond_index, [sigma])
+    image_cond_in = assemble(buffers, "image_cond_in", image_cond, cond_index, [image_cond])
+    last = x_in.index_select(0, denoised_image_indexes)
+    return x_in, sigma_in, image_cond_in, last
+
+
+def vectorized_callback(buffers, x, sigma, image_cond, cond_index, denoised_image_indexes):
+    x_in, sigma_in, image_cond_in, last = vectorized(buffers, x, sigma, image_cond, cond_index, denoised_image_indexes)
+    return x_in.clone(), sigma_in.clone(), image_cond_in.clone(), last
+
+
+def timeit(fn, device, iterations):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / iterations * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--device", default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--frames", type=int, nargs="+", default=[16, 32, 64, 128, 256])
+    parser.add_argument("--size", type=int, default=64, help="latent height and width")
+    parser.add_argument("--iterations", type=int, default=50)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    print(f"{'frames':>8} {'legacy ms':>10} {'vectorized ms':>14} {'with callback ms':>17}")
+    for frames in args.frames:
+        x = torch.randn(frames, 4, args.size, args.size, device=device)
+        sigma = torch.rand(frames, device=device)
+        image_cond = torch.zeros(frames, 5, 1, 1, device=device)
+        repeats = [1] * frames
+        denoised_image_indexes = list(range(frames))
+        cond_index = torch.arange(frames, device=device).repeat_interleave(torch.tensor(repeats, device=device))
+        denoised_index = torch.tensor(denoised_image_indexes, device=device)
+        buffers = {}
+        legacy_ms = timeit(lambda: legacy(x, sigma, image_cond, repeats, denoised_image_indexes), device, args.iterations)
+        vectorized_ms = timeit(lambda: vectorized(buffers, x, sigma, image_cond, cond_index, denoised_index), device, args.iterations)
+        callback_ms = timeit(lambda: vectorized_callback(buffers, x, sigma, image_cond, cond_index, denoised_index), device, args.iterations)
+        print(f"{frames:>8} {legacy_ms:>10.3f} {vectorized_ms:>14.3f} {callback_ms:>17.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Check that AnimateDiffInfV2V.context_windows reproduces the windows of the legacy `uniform` generator exactly.
+
+The legacy generator below is the list-based implementation the vectorised scheduler replaced, kept verbatim as the
+reference. Every combination of steps, video lengths, context batch sizes, strides, overlaps and closed loop modes in
+the grid is compared window by window, with pruning off. Runs on CPU and does not require WebUI to be running, only a
+WebUI checkout (see --webui-dir), e.g.:
+    python tools/check_context_windows.py --steps 64
+"""
+import argparse
+import itertools
+import sys
+
+import numpy as np
+
+import mm_common
+
+
+def legacy_ordered_halving(val):
+    # get binary value, padded with 0s for 64 bits
+    bin_str = f"{val:064b}"
+    # flip binary value, padding included
+    bin_flip = bin_str[::-1]
+    # convert binary to int
+    as_int = int(bin_flip, 2)
+    # divide by 1 << 64, equivalent to 2**64
+    final = as_int / (1 << 64)
+    return final
+
+
+def legacy_uniform(
+    step: int = ...,
+    video_length: int = 0,
+    batch_size: int = 16,
+    stride: int = 1,
+    overlap: int = 4,
+    loop_setting: str = 'R-P',
+):
+    if video_length <= batch_size:
+        yield list(range(batch_size))
+        return
+
+    closed_loop = (loop_setting == 'A')
+    stride = min(stride, int(np.ceil(np.log2(video_length / batch_size))) + 1)
+
+    for context_step in 1 << np.arange(stride):
+        pad = int(round(video_length * legacy_ordered_halving(step)))
+        both_close_loop = False
+        for j in range(
+            int(legacy_ordered_halving(step) * context_step) + pad,
+            video_length + pad + (0 if closed_loop else -overlap),
+            (batch_size * context_step - overlap),
+        ):
+            if loop_setting == 'N' and context_step == 1:
+                current_context = [e % video_length for e in range(j, j + batch_size * context_step, context_step)]
+                first_context = [e % video_length for e in range(0, batch_size * context_step, context_step)]
+                last_context = [e % video_length for e in range(video_length - batch_size * context_step, video_length, context_step)]
+                def get_unsorted_index(lst):
+                    for i in range(1, len(lst)):
+                        if lst[i] < lst[i-1]:
+                            return i
+                    return None
+                unsorted_index = get_unsorted_index(current_context)
+                if unsorted_index is None:
+                    yield current_context
+                elif both_close_loop: # last and this context are close loop
+                    both_close_loop = False
+                    yield first_context
+                elif unsorted_index < batch_size - overlap: # only this context is close loop
+                    yield last_context
+                    yield first_context
+                else: # this and next context are close loop
+                    both_close_loop = True
+                    yield last_context
+            else:
+                yield [e % video_length for e in range(j, j + batch_size * context_step, context_step)]
+
+
+def grid(steps: int):
+    step_values = list(range(steps)) + [255, 256, 1000, 2**20 + 3]
+    video_lengths = list(range(1, 97, 5)) + [128, 200]
+    batch_sizes = [1, 2, 3, 4, 8, 16, 24, 32]
+    for video_length, batch_size in itertools.product(video_lengths, batch_sizes):
+        for overlap in sorted({0, 1, batch_size // 4, batch_size // 2, batch_size - 1}):
+            if overlap >= batch_size:
+                continue
+            for stride, loop_setting, step in itertools.product([1, 2, 3, 4], ['N', 'R-P', 'R+P', 'A'], step_values):
+                yield step, video_length, batch_size, stride, overlap, loop_setting
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare context_windows with the legacy uniform generator.")
+    parser.add_argument("--steps", type=int, default=32, help="check sampling steps 0 .. steps - 1, plus a few large ones")
+    parser.add_argument("--webui-dir", default=None, help="path to stable-diffusion-webui (default: two levels above this extension)")
+    args = parser.parse_args()
+
+    mm_common.setup_webui(args.webui_dir)
+    from scripts.animatediff_infv2v import AnimateDiffInfV2V
+
+    checked, failures = 0, 0
+    for case in grid(args.steps):
+        expected = list(legacy_uniform(*case))
+        try:
+            actual = AnimateDiffInfV2V.context_windows(*case).tolist()
+            generated = list(AnimateDiffInfV2V.uniform(*case))
+        except Exception as e:
+            actual = generated = repr(e)
+        checked += 1
+        if actual != expected or generated != expected:
+            failures += 1
+            if failures <= 10:
+                print(f"Mismatch for (step, video_length, batch_size, stride, overlap, loop) = {case}:\n"
+                      f"  legacy {expected}\n  new    {actual}")
+    for step in range(args.steps):
+        if AnimateDiffInfV2V.ordered_halving(step) != legacy_ordered_halving(step):
+            failures += 1
+            print(f"ordered_halving({step}) differs.")
+    print(f"Checked {checked} window schedules, {failures} mismatches.")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+"""
+Check AnimateDiffOOMGuard on CPU by injecting synthetic out of memory errors from a stub model.
+
+The stub runs out of memory whenever one call holds more rows than its budget, and sliced motion module attention halves
+the memory of a row. Its output mixes the rows of every window, so rows scattered back to the wrong frames or halves
+change the result. For budgets that need one, two or all three degradations, the degraded run has to reproduce the
+unconstrained run exactly and degrade in the documented order: sliced attention, separate cond / uncond calls, fewer
+windows per call. Runs on CPU and does not require WebUI to be running, only a WebUI checkout (see --webui-dir), e.g.:
+    python tools/check_oom_guard.py --video-length 32 --context 8 --windows-per-call 4
+"""
+import argparse
+import sys
+
+import torch
+
+import mm_common
+
+
+class StubMotionModule:
+    def __init__(self):
+        self.attention_slice = None
+
+
+    def set_attention_slice(self, size):
+        self.attention_slice = size
+
+
+class StubModel:
+    def __init__(self, x: torch.Tensor, budget: float, mm: StubMotionModule):
+        self.x = x
+        self.budget = budget
+        self.mm = mm
+        self.calls = 0
+        self.ooms = 0
+
+
+    def __call__(self, rows: torch.Tensor, context_length: int):
+        memory = len(rows) * (1 if self.mm.attention_slice else 2)
+        if memory > self.budget:
+            self.ooms += 1
+            raise RuntimeError(f"CUDA out of memory. Tried to allocate {memory} rows, budget {self.budget}.")
+        self.calls += 1
+        # every context_length rows are one video of one window, the stand-in for temporal attention mixes them
+        x = self.x[rows].unflatten(0, (-1, context_length))
+        return (x + x.mean(dim=1, keepdim=True) * torch.arange(1, context_length + 1)[None, :, None]).flatten(0, 1)
+
+
+def run(guard_cls, windows, halves, x, budget, mm):
+    guard = guard_cls()
+    model = StubModel(x, budget, mm)
+    mm.attention_slice = None
+    x_out = torch.zeros_like(x)
+    for contexts, out in guard.run(windows, halves, model):
+        # scatter back like mm_sd_forward with "Last window" fusion
+        for context, out_context in zip(contexts, out.split([len(c) for c in contexts])):
+            x_out[context] = out_context
+    return x_out, guard, model
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inject synthetic OOMs into AnimateDiffOOMGuard and compare with an unconstrained run.")
+    parser.add_argument("--video-length", type=int, default=32)
+    parser.add_argument("--context", type=int, default=8, help="context batch size")
+    parser.add_argument("--overlap", type=int, default=2)
+    parser.add_argument("--halves", type=int, default=4, help="cond / uncond halves times videos per batch")
+    parser.add_argument("--windows-per-call", type=int, default=4)
+    parser.add_argument("--webui-dir", default=None, help="path to stable-diffusion-webui (default: two levels above this extension)")
+    args = parser.parse_args()
+
+    mm_common.setup_webui(args.webui_dir)
+    from modules import options, shared
+    from scripts.animatediff_infv2v import AnimateDiffInfV2V, AnimateDiffOOMGuard
+    from scripts.animatediff_mm import mm_animatediff as motion_module
+    if shared.opts is None:
+        shared.opts = options.Options({}, set())
+    shared.opts.data["animatediff_windows_per_call"] = args.windows_per_call
+    mm = motion_module.mm = StubMotionModule()
+
+    windows = AnimateDiffInfV2V.context_windows(0, args.video_length, args.context, 1, args.overlap, 'R-P')
+    halves = torch.arange(args.halves, dtype=torch.int64) * args.video_length
+    x = torch.randn((args.video_length * args.halves, 4), generator=torch.Generator().manual_seed(0))
+    reference, _, _ = run(AnimateDiffOOMGuard, windows, halves, x, float("inf"), mm)
+
+    rows = min(args.windows_per_call, len(windows)) * args.context * args.halves
+    # budget, expected (sliced attention, separate halves, windows per call) after the run
+    cases = [
+        ("no OOM", 2 * rows, (False, False, None)),
+        ("sliced attention", rows, (True, False, None)),
+        ("separate halves", rows // args.halves, (True, True, None)),
+        ("fewer windows per call", args.context, (True, True, 1)),
+    ]
+    failures = 0
+    for name, budget, expected in cases:
+        x_out, guard, model = run(AnimateDiffOOMGuard, windows, halves, x, budget, mm)
+        state = (guard.sliced_attention, guard.split_halves, guard.windows_per_call)
+        ok = torch.equal(x_out, reference) and state == expected and model.ooms == guard.retries
+        failures += not ok
+        print(f"{name:24s} budget {budget:5}: {'ok' if ok else 'FAILED'}, {model.ooms} OOMs, {guard.retries} retries, "
+              f"{model.calls} calls, degraded to {state} (expected {expected}), max |x - reference| {(x_out - reference).abs().max().item():.1e}")
+
+    try:
+        run(AnimateDiffOOMGuard, windows, halves, x, args.context - 1, mm)
+        print("Budget below one window did not raise.")
+        failures += 1
+    except RuntimeError as e:
+        print(f"Budget below one window raises after every degradation: {e}")
+    mm.attention_slice = None
+    motion_module.mm = None
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
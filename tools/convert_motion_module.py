@@ -0,0 +1,65 @@
+"""
+Convert a motion module to a canonical fp16 / bf16 safetensors file that loads fast.
+
+Example:
+    python tools/convert_motion_module.py model/mm_sd_v15_v2.ckpt --benchmark
+
+The architecture and max_len are written to the safetensors header, so AnimateDiff does not guess the architecture
+when loading it. The sha256 of the source checkpoint is kept as animatediff_source_sha256, the converted file is
+still identified by its own hash.
+Runs on CPU and does not require WebUI to be running, only a WebUI checkout (see --webui-dir).
+"""
+import argparse
+import os
+import time
+
+import mm_common
+
+
+def load_like_webui(path: str):
+    """
+    Time what AnimateDiffMM._load does on CPU: read, detect architecture, build MotionWrapper.
+    Hashing is left out, WebUI caches the hash of a file after its first load.
+    """
+    from motion_module import MotionModuleType, MotionWrapper
+    model_hash = mm_common.sha256(path)
+    start = time.perf_counter()
+    metadata = mm_common.read_metadata(path)
+    state_dict = mm_common.load_state_dict(path)
+    model_type = MotionModuleType.from_metadata(metadata) or MotionModuleType.get_mm_type(state_dict)
+    mm = MotionWrapper(os.path.basename(path), model_hash, model_type)
+    mm.load_state_dict(state_dict)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a motion module to fast-load safetensors.")
+    parser.add_argument("input", help="motion module in any supported format (.ckpt / .pth / .safetensors)")
+    parser.add_argument("output", nargs="?", default=None, help="output path (default: <input>.<precision>.safetensors)")
+    parser.add_argument("--precision", choices=["fp16", "bf16"], default="fp16")
+    parser.add_argument("--benchmark", action="store_true", help="compare load time of input and output")
+    parser.add_argument("--webui-dir", default=None, help="path to stable-diffusion-webui (default: two levels above this extension)")
+    args = parser.parse_args()
+    output = args.output or f"{os.path.splitext(args.input)[0]}.{args.precision}.safetensors"
+    assert os.path.abspath(output) != os.path.abspath(args.input), "Output would overwrite input."
+
+    mm_common.setup_webui(args.webui_dir)
+    source_metadata = mm_common.read_metadata(args.input)
+    # a converted input keeps pointing at the model it was converted from
+    source_hash = source_metadata.get("animatediff_source_sha256", None) or mm_common.sha256(args.input)
+    mm = mm_common.build_motion_module(args.input, source_hash)
+    print(f"Loaded {args.input} as {mm.mm_type.name} with max_len {mm.max_len}.")
+
+    # a generic sha256 key would describe the input, not the converted file
+    metadata = {k: v for k, v in source_metadata.items() if k not in ["mm_type", "max_len", "precision", "sha256"]}
+    metadata["animatediff_source_sha256"] = source_hash
+    mm_common.save_motion_module(mm, output, args.precision, metadata)
+    print(f"Saved {output}.")
+
+    if args.benchmark:
+        for path in [args.input, output]:
+            print(f"{path}: {os.path.getsize(path) / 2**20:.1f} MiB, loaded in {load_like_webui(path):.3f}s")
+
+
+if __name__ == "__main__":
+    main()
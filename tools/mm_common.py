@@ -0,0 +1,78 @@
+import hashlib
+import json
+import os
+import re
+import sys
+
+EXTENSION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WEBUI_DIR = os.path.dirname(os.path.dirname(EXTENSION_DIR))
+
+
+def setup_webui(webui_dir: str = None):
+    """
+    Make WebUI and this extension importable from a command line tool without launching WebUI.
+    Motion modules are built from WebUI's `ldm` code, so a WebUI checkout is still required on disk.
+    """
+    webui_dir = os.path.abspath(webui_dir or DEFAULT_WEBUI_DIR)
+    assert os.path.isdir(os.path.join(webui_dir, "modules")), f"{webui_dir} is not a stable-diffusion-webui directory."
+    os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+    sys.argv = sys.argv[:1]
+    for path in [webui_dir, EXTENSION_DIR]:
+        if path not in sys.path:
+            sys.path.insert(0, path)
+    import modules.paths # noqa: F401, registers ldm/sgm repositories
+
+
+def load_state_dict(path: str):
+    import torch
+    if os.path.splitext(path)[1].lower() == ".safetensors":
+        import safetensors.torch
+        return safetensors.torch.load_file(path, device="cpu")
+    state_dict = torch.load(path, map_location="cpu")
+    return state_dict.get("state_dict", state_dict)
+
+
+def read_metadata(path: str):
+    if os.path.splitext(path)[1].lower() != ".safetensors":
+        return {}
+    from safetensors import safe_open
+    with safe_open(path, framework="pt", device="cpu") as f:
+        return f.metadata() or {}
+
+
+def sha256(path: str):
+    hash_sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            hash_sha256.update(chunk)
+    return hash_sha256.hexdigest()
+
+
+def convert_mm_name_to_compvis(key: str):
+    # same conversion as AnimateDiffLora.convert_mm_name_to_compvis, without importing WebUI's Lora extension
+    sd_module_key, _, network_part = re.split(r'(_lora\.)', key)
+    sd_module_key = sd_module_key.replace("processor.", "").replace("to_out", "to_out.0")
+    return sd_module_key, 'lora_' + network_part
+
+
+def build_motion_module(path: str, model_hash: str = None):
+    from motion_module import MotionModuleType, MotionWrapper
+    state_dict = load_state_dict(path)
+    model_type = MotionModuleType.get_mm_type(state_dict)
+    mm = MotionWrapper(os.path.basename(path), model_hash, model_type)
+    mm.load_state_dict(state_dict)
+    return mm.eval()
+
+
+def save_motion_module(mm, path: str, precision: str = "fp16", metadata: dict = None):
+    import torch
+    import safetensors.torch
+    dtype = {"fp16": torch.float16, "bf16": torch.bfloat16, "fp32": torch.float32}[precision]
+    state_dict = {k: (v.to(dtype) if v.is_floating_point() else v).contiguous() for k, v in mm.state_dict().items()}
+    header = {
+        "mm_type": mm.mm_type.name,
+        "max_len": str(mm.max_len),
+        "precision": precision,
+    }
+    header.update({k: v if isinstance(v, str) else json.dumps(v) for k, v in (metadata or {}).items()})
+    safetensors.torch.save_file(state_dict, path, metadata=header)
@@ -0,0 +1,319 @@
+"""
+Render one long AnimateDiff video as overlapping segments on several WebUI workers, then blend the segments back together.
+
+Each segment is a txt2img API request for a range of frames of the whole video. WebUI seeds frame i of a batch with seed + i,
+so a segment starting at frame s is sent with seed + s and every frame keeps the noise it has in a single render.
+Prompt travel keyframes are shifted into each segment, and the last keyframe before a segment becomes its frame 0.
+A segment that starts or ends between two interpolated keyframes is refused, because keyframes cannot carry the interpolation.
+Frames shared by two segments are cross-faded in pixel space.
+
+Example, with two WebUI instances started with --api:
+    python tools/render_segments.py payload.json output_dir --video-length 256 --segment-length 64 --overlap 16 \
+        --worker http://127.0.0.1:7860 --worker http://127.0.0.1:7861
+
+payload.json is a /sdapi/v1/txt2img payload with a fixed seed and AnimateDiff in alwayson_scripts.
+Use --stub N instead of --worker to run the coordinator with N local processes and a stub renderer, no running WebUI or GPU
+needed. The stub still passes every segment payload through AnimateDiffProcess as WebUI does, so it has to run with the
+Python environment of WebUI, from the WebUI directory with the extension in extensions/. The blended stub frames are
+compared with a single stub render of the whole video.
+"""
+import argparse
+import base64
+import copy
+import hashlib
+import io
+import json
+import os
+import queue
+import random
+import re
+import sys
+import urllib.request
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+def split_segments(video_length: int, segment_length: int, overlap: int):
+    """
+    (start, end) frame ranges of overlapping segments. Segments advance by segment_length - overlap,
+    the last segment is moved back to end at the last frame, like the chunks of streaming mode.
+    """
+    assert 0 <= overlap < segment_length, "Overlap should be smaller than segment length."
+    if video_length <= segment_length:
+        return [(0, video_length)]
+    step = segment_length - overlap
+    chunks = 1 + -(-(video_length - segment_length) // step)
+    starts = [min(i * step, video_length - segment_length) for i in range(chunks)]
+    return [(start, start + segment_length) for start in starts]
+
+
+def parse_prompt(prompt: str):
+    """
+    (head lines, {keyframe: prompt}, tail lines) of a prompt travel prompt, split the same way as AnimateDiffPromptSchedule.parse_prompt.
+    """
+    head, keyframes, tail = [], {}, []
+    mode = 'head'
+    for line in prompt.strip().split('\n'):
+        if mode == 'head' and re.match(r'^\d+:', line):
+            mode = 'mapp'
+        if mode == 'mapp':
+            match = re.match(r'^(\d+): (.+)$', line)
+            if match:
+                keyframes[int(match.group(1))] = match.group(2)
+                continue
+            mode = 'tail'
+        (head if mode == 'head' else tail).append(line)
+    return head, keyframes, tail
+
+
+def slice_prompt(prompt: str, start: int, end: int):
+    """
+    Prompt travel of frames [start, end). Keyframes are shifted by start, and the last keyframe before start is moved to frame 0.
+    Frames of a segment only get the same prompts as in a single render when the segment does not start or end between two
+    interpolated keyframes, see check_prompt_schedule.
+    """
+    head, keyframes, tail = parse_prompt(prompt)
+    if not keyframes:
+        return prompt
+
+    sliced = {frame - start: text for frame, text in keyframes.items() if start <= frame < end}
+    before = [frame for frame in keyframes if frame <= start]
+    if 0 not in sliced:
+        sliced[0] = keyframes[max(before)] if before else keyframes[min(keyframes)]
+    return '\n'.join(head + [f"{frame}: {sliced[frame]}" for frame in sorted(sliced)] + tail)
+
+
+def prompt_schedule(prompt: str, video_length: int, closed_loop: bool = False):
+    """
+    Per-frame (prompt of the previous keyframe, prompt of the next keyframe or None, rate) of prompt travel,
+    the same schedule as AnimateDiffPromptSchedule.compile_schedule.
+    """
+    _, keyframes, _ = parse_prompt(prompt)
+    if not keyframes:
+        return [(prompt, None, 0.0)] * video_length
+    keys = sorted(keyframes)
+    schedule = []
+    for frame in range(video_length):
+        key_prev, key_next = (keys[-1], keys[0]) if closed_loop else (keys[0], keys[-1])
+        for key in keys:
+            if key > frame:
+                key_next = key
+                break
+            key_prev = key
+        dist_prev = (frame - key_prev) % video_length
+        dist_next = (key_next - frame) % video_length
+        rate = dist_prev / (dist_prev + dist_next) if key_prev != key_next and dist_prev + dist_next > 0 else 0.0
+        if rate == 0.0 or keyframes[key_prev] == keyframes[key_next]:
+            schedule.append((keyframes[key_prev], None, 0.0))
+        else:
+            schedule.append((keyframes[key_prev], keyframes[key_next], rate))
+    return schedule
+
+
+def prompt_closed_loop(args: dict, video_length: int):
+    # same condition as mm_cfg_forward, auto context batch size counted as 16
+    return video_length > (args.get("batch_size", 16) or 16) and args.get("closed_loop", "R-P") in ["R+P", "A"]
+
+
+def check_prompt_schedule(payload: dict, segments: list, video_length: int):
+    """
+    Keyframes cannot express a prompt interpolated between two keyframes, so a segment that starts or ends between two
+    interpolated keyframes gives its frames other prompts than a single render. Stop and ask for keyframes at those boundaries.
+    """
+    prompt = payload.get("prompt", "")
+    closed_loop = prompt_closed_loop(get_animatediff_args(payload), video_length)
+    full = prompt_schedule(prompt, video_length, closed_loop)
+    _, keyframes, _ = parse_prompt(prompt)
+    frames, boundaries = set(), set()
+    for start, end in segments:
+        sliced = prompt_schedule(slice_prompt(prompt, start, end), end - start)
+        mismatch = [start + i for i, entry in enumerate(sliced) if entry != full[start + i]]
+        if mismatch:
+            frames.update(mismatch)
+            boundaries.update(frame for frame in (start, end - 1) if frame not in keyframes)
+    if not frames:
+        return
+    message = f"Prompt travel interpolates across segment boundaries, {len(frames)} frames between {min(frames)} and {max(frames)} would get other prompts than in a single render."
+    if closed_loop:
+        message += " Closed loop R+P / A interpolates the last keyframe back to the first, which segments cannot do, use R-P or N."
+    if boundaries:
+        message += f" Add keyframes at frames {sorted(boundaries)}, or choose segments that start and end on keyframes."
+    raise AssertionError(message)
+
+
+def get_animatediff_args(payload: dict):
+    scripts = payload.get("alwayson_scripts", {})
+    key = next((k for k in scripts if k.lower() == "animatediff"), None)
+    assert key is not None, "AnimateDiff is not in alwayson_scripts of the payload."
+    args = scripts[key]["args"]
+    assert len(args) == 1 and isinstance(args[0], dict), "AnimateDiff args should be a list with one dict."
+    return args[0]
+
+
+def segment_payload(payload: dict, index: int, start: int, end: int):
+    segment = copy.deepcopy(payload)
+    segment["seed"] = int(payload["seed"]) + start
+    segment["prompt"] = slice_prompt(payload.get("prompt", ""), start, end)
+    segment["n_iter"] = 1
+    args = get_animatediff_args(segment)
+    args.update({
+        "enable": True,
+        "video_length": end - start,
+        # the ends of a segment are not the ends of the video
+        "closed_loop": "N",
+        # WebUI requires a saving format, Frame returns the frames in the API response
+        "format": ["PNG", "Frame"],
+        "stream": False,
+        "video_count": 1,
+    })
+    if args.get("request_id"):
+        args["request_id"] = f"{args['request_id']}-segment{index:03}"
+    return segment
+
+
+def render_http(url: str, payload: dict):
+    request = urllib.request.Request(
+        f"{url.rstrip('/')}/sdapi/v1/txt2img",
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+    )
+    with urllib.request.urlopen(request) as response:
+        images = json.loads(response.read())["images"]
+    video_length = get_animatediff_args(payload)["video_length"]
+    # the response may start with a grid or encoded videos, frames come last
+    frames = [Image.open(io.BytesIO(base64.b64decode(image.split(",", 1)[-1]))) for image in images[-video_length:]]
+    return [np.asarray(frame.convert("RGB")) for frame in frames]
+
+
+def check_payload(payload: dict):
+    """
+    Parse the AnimateDiff args of a segment payload with AnimateDiffProcess and set_p like WebUI does before sampling,
+    so that the stub rejects payloads a worker would reject.
+    """
+    os.environ.setdefault("IGNORE_CMD_ARGS_ERRORS", "1")
+    sys.path.insert(0, os.getcwd())
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from types import SimpleNamespace
+    from modules import options, shared
+    from scripts.animatediff_ui import AnimateDiffProcess
+    if shared.opts is None:
+        # WebUI defaults, the settings of a worker may differ
+        shared.opts = options.Options({}, set())
+    params = AnimateDiffProcess(**get_animatediff_args(payload))
+    p = SimpleNamespace(batch_size=payload.get("batch_size", 1), n_iter=payload.get("n_iter", 1), do_not_save_samples=False)
+    params.set_p(p)
+
+
+def render_stub(payload: dict):
+    """
+    Stand-in for WebUI: frame i of a segment is drawn from seed + i and from the prompt travel schedule of its segment payload,
+    so a segment only gives back the frames of a single render when its seed and prompt are sliced correctly.
+    """
+    args = get_animatediff_args(payload)
+    video_length = args["video_length"]
+    width, height = payload.get("width", 64), payload.get("height", 64)
+    schedule = prompt_schedule(payload.get("prompt", ""), video_length, prompt_closed_loop(args, video_length))
+    frames = []
+    for i, entry in enumerate(schedule):
+        frame = np.random.default_rng(payload["seed"] + i).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        prompt_shift = hashlib.sha256(repr(entry).encode("utf-8")).digest()[0]
+        frames.append(frame + np.uint8(prompt_shift))
+    return frames
+
+
+def blend_segments(segments: list, frames: list, video_length: int):
+    """
+    Reassemble the frames of all segments. Where two segments overlap, the earlier one fades out linearly
+    and the later one fades in.
+    """
+    result = [None] * video_length
+    for (start, end), segment_frames in zip(segments, frames):
+        assert len(segment_frames) == end - start, f"Segment {start}-{end} returned {len(segment_frames)} frames."
+        overlapped = [f for f in range(start, end) if result[f] is not None]
+        for i, frame in enumerate(segment_frames):
+            f = start + i
+            frame = frame.astype(np.float32)
+            if result[f] is None:
+                result[f] = frame
+            else:
+                weight = (overlapped.index(f) + 1) / (len(overlapped) + 1)
+                result[f] = result[f] * (1 - weight) + frame * weight
+    return [np.clip(np.rint(frame), 0, 255).astype(np.uint8) for frame in result]
+
+
+def render(payload: dict, video_length: int, segment_length: int, overlap: int, workers: list = None, stub: int = 0):
+    if int(payload.get("seed", -1)) == -1:
+        # all segments have to share one seed
+        payload = {**payload, "seed": random.randrange(2**32 - video_length)}
+    segments = split_segments(video_length, segment_length, overlap)
+    check_prompt_schedule(payload, segments, video_length)
+    payloads = [segment_payload(payload, i, start, end) for i, (start, end) in enumerate(segments)]
+    print(f"Rendering {video_length} frames as {len(segments)} segments: {segments}")
+
+    if stub > 0:
+        for job in payloads:
+            check_payload(job)
+        with ProcessPoolExecutor(max_workers=stub) as executor:
+            frames = list(executor.map(render_stub, payloads))
+    else:
+        assert workers, "No workers given."
+        # each worker renders one segment at a time
+        idle = queue.Queue()
+        for url in workers:
+            idle.put(url)
+
+        def run(job):
+            url = idle.get()
+            try:
+                return render_http(url, job)
+            finally:
+                idle.put(url)
+
+        with ThreadPoolExecutor(max_workers=len(workers)) as executor:
+            frames = list(executor.map(run, payloads))
+    result = blend_segments(segments, frames, video_length)
+
+    if stub > 0:
+        # a stub frame only depends on its seed and prompt, so the blended segments must match a single render
+        reference = copy.deepcopy(payload)
+        get_animatediff_args(reference)["video_length"] = video_length
+        reference = render_stub(reference)
+        differences = [f for f, (a, b) in enumerate(zip(result, reference)) if not np.array_equal(a, b)]
+        assert not differences, f"Blended segments differ from a single render at {len(differences)} frames, the first is {differences[0]}."
+        print(f"Blended segments match a single render of {video_length} frames.")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a long AnimateDiff video as overlapping segments on several WebUI workers.")
+    parser.add_argument("payload", help="txt2img API payload (json) with AnimateDiff in alwayson_scripts")
+    parser.add_argument("output", help="output directory for frames and GIF")
+    parser.add_argument("--video-length", type=int, default=None, help="number of frames of the whole video (default: video_length of the payload)")
+    parser.add_argument("--segment-length", type=int, default=64, help="frames per segment")
+    parser.add_argument("--overlap", type=int, default=16, help="frames shared by neighbouring segments")
+    parser.add_argument("--worker", action="append", default=[], help="WebUI base URL, may be repeated")
+    parser.add_argument("--stub", type=int, default=0, metavar="N", help="use N local processes with a stub renderer instead of WebUI")
+    parser.add_argument("--fps", type=int, default=None, help="GIF frames per second (default: fps of the payload)")
+    args = parser.parse_args()
+
+    with open(args.payload, "r", encoding="utf-8") as f:
+        payload = json.load(f)
+    ad_args = get_animatediff_args(payload)
+    video_length = args.video_length or ad_args.get("video_length", 0)
+    assert video_length > 0, "Number of frames of the whole video is required."
+
+    frames = render(payload, video_length, args.segment_length, args.overlap, args.worker, args.stub)
+
+    os.makedirs(args.output, exist_ok=True)
+    images = [Image.fromarray(frame) for frame in frames]
+    for i, image in enumerate(images):
+        image.save(os.path.join(args.output, f"{i:05}.png"))
+    fps = args.fps or ad_args.get("fps", 8)
+    images[0].save(os.path.join(args.output, "video.gif"), save_all=True, append_images=images[1:], duration=1000 / fps, loop=0)
+    print(f"Saved {len(images)} frames to {args.output}.")
+
+
+if __name__ == "__main__":
+    main()